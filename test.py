@@ -1,24 +1,54 @@
 #!/usr/bin/env python2.7
-import re
-import subprocess
-import sys
+import argparse
+import array
+import bisect
+import collections
+import hashlib
+import heapq
 import json
+import marshal
+import mmap
+import multiprocessing
+import os
+import resource
+import shutil
+import SocketServer
+import stat
+import struct
+import sys
+import tempfile
+import time
 
+from elftools.common.utils import parse_cstring_from_stream
 from elftools.dwarf import dwarfinfo
+from elftools.dwarf.die import AttributeValue, DIE
+from elftools.dwarf.dwarf_expr import DW_OP_opcode2name
+from elftools.dwarf.enums import ENUM_DW_FORM
 from io import BytesIO
 
 CONFIG = dwarfinfo.DwarfConfig(little_endian=True,
                                machine_arch='x64',
                                default_address_size=8)
 
-SEGMENT_DIVIDER = re.compile(r"Load command \d\s+cmd LC_SEGMENT_64\n")
+# Mach-O constants and on-disk structures, from <mach-o/loader.h>. We only
+# handle little-endian 64-bit files, to match CONFIG above.
+
+MH_MAGIC_64 = 0xfeedfacf
+
+LC_SEGMENT_64 = 0x19
+LC_UUID = 0x1b
 
-SECTION_DIVIDER = re.compile(r"Section\n")
+MACH_HEADER_64 = struct.Struct("<IiiIIIII")
+LOAD_COMMAND = struct.Struct("<II")
+SEGMENT_COMMAND_64 = struct.Struct("<II16sQQQQiiII")
+SECTION_64 = struct.Struct("<16s16sQQIIIIIIII")
+UUID_COMMAND = struct.Struct("<II16s")
 
 DWARF_SEGNAME = "__DWARF"
 
 WANTED_SECTIONS = set([
     "debug_info_sec",
+    "debug_aranges_sec",
     "debug_abbrev_sec",
     "debug_frame_sec",
     "debug_str_sec",
@@ -35,46 +65,173 @@ def fix_name(name):
     # Get rid of leading __ in the section name.
     return name[2:] + "_sec"
 
-# TODO actually parse otool output
+def c_string(raw):
+    """ Decode a fixed-width, NUL-padded name field from a Mach-O structure.
+    """
+    return raw.split("\0", 1)[0]
+
+def read_struct(handle, layout):
+    data = handle.read(layout.size)
+    if len(data) != layout.size:
+        raise Exception("Truncated Mach-O file")
+    return layout.unpack(data)
+
+def iter_load_commands(handle):
+    """ Walk the load commands of a Mach-O file, yielding the `cmd` of each with
+        `handle` positioned at the start of that command.
+    """
+    handle.seek(0)
+    header = read_struct(handle, MACH_HEADER_64)
+    magic, ncmds = header[0], header[4]
+    if magic != MH_MAGIC_64:
+        raise Exception("Not a little-endian 64-bit Mach-O file: magic=%#x" % magic)
+
+    command_offset = MACH_HEADER_64.size
+    for _ in xrange(ncmds):
+        handle.seek(command_offset)
+        cmd, cmdsize = read_struct(handle, LOAD_COMMAND)
+        if cmdsize < LOAD_COMMAND.size:
+            raise Exception("Malformed load command at offset %d" % command_offset)
+
+        handle.seek(command_offset)
+        yield cmd
+
+        command_offset += cmdsize
+
+def iter_segments(handle):
+    """ Yield (segname, sections) for every LC_SEGMENT_64 in a Mach-O file,
+        where sections is a list of (sectname, offset, size) tuples.
+    """
+    for cmd in iter_load_commands(handle):
+        if cmd == LC_SEGMENT_64:
+            segment = read_struct(handle, SEGMENT_COMMAND_64)
+            segname, nsects = c_string(segment[2]), segment[9]
+            sections = []
+            for _ in xrange(nsects):
+                section = read_struct(handle, SECTION_64)
+                sections.append((c_string(section[0]), section[4], section[3]))
+            yield segname, sections
+
+def read_uuid(handle):
+    """ Return the 16 byte LC_UUID of a Mach-O file, or None if it has none.
+    """
+    for cmd in iter_load_commands(handle):
+        if cmd == LC_UUID:
+            return read_struct(handle, UUID_COMMAND)[2]
+    return None
+
+class MappedSectionStream(object):
+    """ A read-only, seekable file-like view of one section of a memory-mapped
+        file. Nothing is copied up front; each read() slices just the requested
+        bytes out of the mapping.
+    """
+
+    def __init__(self, mapping, offset, size):
+        self._mapping = mapping
+        self._start = offset
+        self._end = offset + size
+        self._pos = offset
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            end = self._end
+        else:
+            end = min(self._pos + size, self._end)
+        data = self._mapping[self._pos:end]
+        self._pos = max(self._pos, end)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            pos = self._start + offset
+        elif whence == os.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == os.SEEK_END:
+            pos = self._end + offset
+        else:
+            raise ValueError("Invalid whence: %r" % whence)
+        if pos < self._start:
+            raise ValueError("Negative seek position")
+        self._pos = pos
+        return self.tell()
+
+    def tell(self):
+        return self._pos - self._start
+
+class LazySectionStream(object):
+    """ Defers opening a section's underlying stream until it is first
+        accessed, and tallies the bytes read through it into `stats`, keyed by
+        section name. Bytes read more than once count each time. Sections that
+        are never touched never appear in `stats`.
+    """
+
+    def __init__(self, name, open_stream, stats):
+        self._name = name
+        self._open_stream = open_stream
+        self._stats = stats
+        self._stream = None
+
+    def _get_stream(self):
+        if self._stream is None:
+            self._stream = self._open_stream()
+            self._stats.setdefault(self._name, 0)
+        return self._stream
+
+    def read(self, size=-1):
+        data = self._get_stream().read(size)
+        self._stats[self._name] += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self._get_stream().seek(offset, whence)
+
+    def tell(self):
+        return self._get_stream().tell()
+
+def read_section(handle, sectname, offset, size, stats, mapping=None):
+    name = fix_name(sectname)
 
-def get_attribute(s, name):
-    name_index = s.index(name)
-    newline_index = s.index("\n", name_index)
-    return s[name_index + len(name) + 1 : newline_index]
+    def open_stream():
+        if mapping is not None:
+            return MappedSectionStream(mapping, offset, size)
+        handle.seek(offset)
+        return BytesIO(handle.read(size))
 
-def read_section(string, handle):
-    name = fix_name(get_attribute(string, "sectname"))
-    size = int(get_attribute(string, "size"), base=16)
-    offset = int(get_attribute(string, "offset"))
-    handle.seek(offset)
-    stream = BytesIO(handle.read(size))
-    return dwarfinfo.DebugSectionDescriptor(stream=stream,
+    return dwarfinfo.DebugSectionDescriptor(stream=LazySectionStream(name, open_stream, stats),
                                             name=name,
                                             global_offset=offset,
                                             size=size)
 
-def read_dwarf_sections(filename):
-    pipe = subprocess.Popen("otool -l %s" % filename, stdout=subprocess.PIPE, shell=True)
-    text = pipe.stdout.read()
+def read_dwarf_sections(filename, use_mmap=False, stats=None):
+    """ Find the __DWARF segment of the given Mach-O file and return a dict of
+        DebugSectionDescriptors suitable for passing to DWARFInfo. Section
+        bytes are not loaded until pyelftools first reads them; pass a dict as
+        `stats` to collect the number of bytes transferred from each touched
+        section, which counts bytes read repeatedly each time.
+        With `use_mmap`, the file is mapped once and every section's stream is
+        a view over that mapping instead of a private copy.
+    """
+    if stats is None:
+        stats = {}
 
-    segments = SEGMENT_DIVIDER.split(text)[1:]
+    handle = open(filename, "rb")
 
     dwarf_segment = None
-    for s in segments:
-        segname = get_attribute(s, "segname")
+    for segname, sections in iter_segments(handle):
         if segname == DWARF_SEGNAME:
-            dwarf_segment = s
+            dwarf_segment = sections
 
-    if not dwarf_segment:
+    if dwarf_segment is None:
         raise Exception("Could not find DWARF segment")
 
-    sections = SECTION_DIVIDER.split(dwarf_segment)[1:]
-    handle = open(filename, "r")
+    mapping = None
+    if use_mmap:
+        mapping = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
 
     descriptors = {}
-    for s in sections:
-        descriptor = read_section(s, handle)
-        if want_section(descriptor.name):
+    for sectname, offset, size in dwarf_segment:
+        if want_section(fix_name(sectname)):
+            descriptor = read_section(handle, sectname, offset, size, stats, mapping)
             descriptors[descriptor.name] = descriptor
 
     for s in WANTED_SECTIONS:
@@ -83,49 +240,1458 @@ def read_dwarf_sections(filename):
 
     return descriptors
 
+def print_section_stats(sections, stats, out):
+    for name in sorted(sections):
+        descriptor = sections[name]
+        if descriptor is None:
+            status = "missing"
+        elif name in stats:
+            # Not distinct bytes: pyelftools rereads some, such as the top DIEs.
+            status = "%d bytes transferred from %d byte section" % (stats[name], descriptor.size)
+        else:
+            status = "untouched"
+        print >>out, "%s: %s" % (name, status)
+
+
+class LineTable(object):
+    """ A sorted, array-backed address -> (file, line, column) table built once
+        from line programs, so each lookup is a binary search instead of a
+        replay of every line program.
+
+        Each row covers the addresses from its own address up to the next row's;
+        the end of a sequence is stored as a row with no file, marking a gap.
+    """
+
+    NO_FILE = -1
+
+    def __init__(self, lineprogs):
+        self._filenames = []
+        self._file_indices = {}
+
+        rows = []
+        for lineprog in lineprogs:
+            # CUs without a DW_AT_stmt_list have no line program.
+            if lineprog is None:
+                continue
+            file_entries = lineprog["file_entry"]
+            for entry in lineprog.get_entries():
+                # We're interested in those entries where a new state is assigned
+                state = entry.state
+                if state is None:
+                    continue
+                if state.end_sequence:
+                    # Sort gaps before any row at the same address, so that a
+                    # sequence starting where another ends wins the lookup.
+                    rows.append((state.address, 0, self.NO_FILE, 0, 0))
+                else:
+                    file_index = self._intern_file(file_entries[state.file - 1].name)
+                    rows.append((state.address, 1, file_index, state.line, state.column))
+
+        # Stable sort, so rows sharing an address keep their line program order
+        # and the last one wins, as when replaying the program.
+        rows.sort(key=lambda row: row[:2])
+
+        self._addresses = array.array("L", (row[0] for row in rows))
+        self._files = array.array("l", (row[2] for row in rows))
+        self._lines = array.array("l", (row[3] for row in rows))
+        self._columns = array.array("l", (row[4] for row in rows))
+
+    def location_for(self, address):
+        """ Return the {"source", "line", "column"} location of `address`, or
+            None if no line program covers it.
+        """
+        return self._location_at(bisect.bisect_right(self._addresses, address) - 1)
+
+    def locations_for_sorted(self, addresses):
+        """ Return the location_for each of `addresses`, which must be sorted,
+            in one forward sweep over the table.
+        """
+        rows = self._addresses
+        count = len(rows)
+        location_at = self._location_at
+        locations = []
+        i = 0
+        for address in addresses:
+            # Rows before i are at or before the previous address. The next
+            # address is usually in the same row or the one after; only
+            # longer strides are bisected.
+            if i < count and rows[i] <= address:
+                i += 1
+                if i < count and rows[i] <= address:
+                    i = bisect.bisect_right(rows, address, i + 1)
+            locations.append(location_at(i - 1))
+        return locations
+
+    def _location_at(self, i):
+        if i < 0 or self._files[i] == self.NO_FILE:
+            return None
+        return {
+            "source": self._filenames[self._files[i]],
+            "line": self._lines[i],
+            "column": self._columns[i]
+        }
+
+    def _intern_file(self, filename):
+        if filename not in self._file_indices:
+            self._file_indices[filename] = len(self._filenames)
+            self._filenames.append(filename)
+        return self._file_indices[filename]
+
+class LineTableIndex(object):
+    """ Maps addresses to the CU that owns them, using .debug_aranges or the CU
+        DIE's own address ranges, and lazily builds and caches a LineTable for
+        just that CU's line program.
+    """
+
+    def __init__(self, dwarf):
+        self.dwarf = dwarf
+        self._cus_by_offset = {}
+        self._tables = {}
+
+        ranges = []
+        aranges = dwarf.get_aranges()
+        if aranges is not None:
+            for entry in aranges.entries:
+                ranges.append((entry.begin_addr, entry.begin_addr + entry.length, entry.info_offset))
+        covered = set(cu_offset for _, _, cu_offset in ranges)
+
+        # CUs with neither aranges nor address attributes are searched one by
+        # one, after the owning CU (if any) comes up empty.
+        self._unranged = []
+        for cu in dwarf.iter_CUs():
+            self._cus_by_offset[cu.cu_offset] = cu
+            if cu.cu_offset in covered:
+                continue
+            cu_ranges = get_DIE_ranges(dwarf, top_DIE(cu))
+            if not cu_ranges:
+                self._unranged.append(cu.cu_offset)
+            for start, end in cu_ranges:
+                ranges.append((start, end, cu.cu_offset))
+
+        ranges.sort()
+        self._starts = array.array("L", (r[0] for r in ranges))
+        self._ends = array.array("L", (r[1] for r in ranges))
+        self._cu_offsets = array.array("L", (r[2] for r in ranges))
 
-# Based on
-# https://github.com/eliben/pyelftools/blob/master/examples/dwarf_decode_address.py
+    def location_for(self, address):
+        """ Return the {"source", "line", "column"} location of `address`, or
+            None if no line program covers it.
+        """
+        i = bisect.bisect_right(self._starts, address) - 1
+        if i >= 0 and address < self._ends[i]:
+            location = self._table_for(self._cu_offsets[i]).location_for(address)
+            if location is not None:
+                return location
+
+        return self._unranged_location_for(address)
+
+    def locations_for(self, addresses):
+        """ Return the location_for each of `addresses`, in the same order.
+            The addresses are sorted and swept through the CU ranges and line
+            tables together, so each table is visited once per batch.
+        """
+        order = sorted(xrange(len(addresses)), key=addresses.__getitem__)
+        locations = [None] * len(addresses)
+
+        # Group the sorted addresses into runs that fall in the same CU range.
+        starts = self._starts
+        ends = self._ends
+        count = len(starts)
+        runs = []
+        run_index = positions = None
+        i = 0
+        for position in order:
+            address = addresses[position]
+            # A forward walk, as in LineTable.locations_for_sorted.
+            if i < count and starts[i] <= address:
+                i += 1
+                if i < count and starts[i] <= address:
+                    i = bisect.bisect_right(starts, address, i + 1)
+            range_index = i - 1 if i > 0 and address < ends[i - 1] else None
+            if positions is None or range_index != run_index:
+                run_index = range_index
+                positions = []
+                runs.append((range_index, positions))
+            positions.append(position)
+
+        # Positions still unresolved, in address order, for the unranged CUs.
+        pending = []
+        for range_index, positions in runs:
+            if range_index is None:
+                pending.extend(positions)
+                continue
+            table = self._table_for(self._cu_offsets[range_index])
+            found = table.locations_for_sorted([addresses[p] for p in positions])
+            for position, location in zip(positions, found):
+                if location is None:
+                    pending.append(position)
+                locations[position] = location
+
+        for cu_offset in self._unranged:
+            if not pending:
+                break
+            table = self._table_for(cu_offset)
+            found = table.locations_for_sorted([addresses[p] for p in pending])
+            still_pending = []
+            for position, location in zip(pending, found):
+                if location is None:
+                    still_pending.append(position)
+                locations[position] = location
+            pending = still_pending
+
+        return locations
+
+    def _unranged_location_for(self, address):
+        for cu_offset in self._unranged:
+            location = self._table_for(cu_offset).location_for(address)
+            if location is not None:
+                return location
+        return None
+
+    def _table_for(self, cu_offset):
+        if cu_offset not in self._tables:
+            cu = self._cus_by_offset[cu_offset]
+            self._tables[cu_offset] = LineTable([line_program_for_CU(self.dwarf, cu)])
+        return self._tables[cu_offset]
+
+CONSTANT_FORMS = set([
+    "DW_FORM_data1",
+    "DW_FORM_data2",
+    "DW_FORM_data4",
+    "DW_FORM_data8",
+    "DW_FORM_sdata",
+    "DW_FORM_udata"
+])
+
+def get_DIE_ranges(dwarf, entry, base_address=None, extents=None):
+    """ Return the list of (start, end) address ranges covered by the DIE, from
+        either its DW_AT_low_pc/DW_AT_high_pc pair or its DW_AT_ranges list.
+        `base_address` is the CU's base address that range list entries are
+        relative to; it defaults to the DIE's own DW_AT_low_pc, as for a CU.
+        The (start, end) offsets of a range list read are added to `extents`,
+        if given.
+    """
+    attributes = entry.attributes
+    low_pc = None
+    if "DW_AT_low_pc" in attributes:
+        low_pc = attributes["DW_AT_low_pc"].value
+
+    if "DW_AT_ranges" in attributes:
+        range_lists = dwarf.range_lists()
+        if range_lists is None:
+            return []
+        if base_address is None:
+            base_address = low_pc or 0
+        offset = attributes["DW_AT_ranges"].value
+        range_list = range_lists.get_range_list_at_offset(offset)
+        if extents is not None:
+            extents.add((offset, range_lists.stream.tell()))
+        ranges = []
+        for r in range_list:
+            if hasattr(r, "base_address"):
+                base_address = r.base_address
+            else:
+                ranges.append((base_address + r.begin_offset, base_address + r.end_offset))
+        return ranges
+
+    if low_pc is not None and "DW_AT_high_pc" in attributes:
+        high_pc = attributes["DW_AT_high_pc"]
+        # Since DWARF 4, a constant-class high_pc is an offset from low_pc.
+        if high_pc.form in CONSTANT_FORMS:
+            return [(low_pc, low_pc + high_pc.value)]
+        return [(low_pc, high_pc.value)]
+
+    return []
+
+def top_DIE(cu):
+    """ Parse just the CU's top DIE, rather than the whole CU as
+        cu.get_top_DIE() does.
+    """
+    return DIE(cu=cu, stream=cu.dwarfinfo.debug_info_sec.stream, offset=cu.cu_die_offset)
+
+def CU_end(cu):
+    """ The .debug_info offset just past the CU.
+    """
+    return cu.cu_offset + cu["unit_length"] + cu.structs.initial_length_field_size()
+
+def CU_base_address(top):
+    """ The address that range lists in the CU with the top DIE `top` are
+        relative to.
+    """
+    if "DW_AT_low_pc" in top.attributes:
+        return top.attributes["DW_AT_low_pc"].value
+    return 0
+
+def line_program_for_CU(dwarf, cu):
+    """ Like dwarf.line_program_for_CU(cu), without parsing the whole CU.
+    """
+    top = top_DIE(cu)
+    if "DW_AT_stmt_list" not in top.attributes:
+        return None
+    return dwarf._parse_line_program_at_offset(top.attributes["DW_AT_stmt_list"].value, cu.structs)
+
+CU_RELATIVE_REFERENCE_FORMS = set([
+    "DW_FORM_ref1",
+    "DW_FORM_ref2",
+    "DW_FORM_ref4",
+    "DW_FORM_ref8",
+    "DW_FORM_ref_udata"
+])
+
+def reference_offset(cu, attribute):
+    """ Return the absolute .debug_info offset that a reference attribute
+        points at. Most reference forms are relative to the CU header, but
+        DW_FORM_ref_addr is already absolute.
+    """
+    if attribute.form in CU_RELATIVE_REFERENCE_FORMS:
+        return attribute.value + cu.cu_offset
+    return attribute.value
+
+# Subtree skipping
 #
-# TODO: binary search is better
-def get_location(dwarf, address):
-    # Go over all the line programs in the DWARF information, looking for
-    # one that describes the given address.
-    for CU in dwarf.iter_CUs():
-        # First, look at line programs to find the file/line for the address
-        lineprog = dwarf.line_program_for_CU(CU)
-        prevstate = None
-        for entry in lineprog.get_entries():
-            # We're interested in those entries where a new state is assigned
-            if entry.state is None or entry.state.end_sequence:
+# Tags whose children, per the DWARF 4 spec, can only have one of the listed
+# tags. Visiting a DIE with one of these tags doesn't need to descend into its
+# children unless one of those tags, or their own possible children, has a
+# visitor. Tags not listed may have any children.
+CHILD_TAGS = {
+    "DW_TAG_enumeration_type": ("DW_TAG_enumerator",),
+    "DW_TAG_enumerator": (),
+    "DW_TAG_member": (),
+    "DW_TAG_GNU_call_site": ("DW_TAG_GNU_call_site_parameter",),
+    "DW_TAG_GNU_call_site_parameter": (),
+    "DW_TAG_template_type_param": (),
+    "DW_TAG_template_value_param": ()
+}
+
+# In C, types and functions can't be declared inside a struct or union, so
+# those only have members.
+C_CHILD_TAGS = dict(CHILD_TAGS, **{
+    "DW_TAG_structure_type": ("DW_TAG_member",),
+    "DW_TAG_union_type": ("DW_TAG_member",)
+})
+
+# DW_AT_language values for C: DW_LANG_C89, DW_LANG_C, DW_LANG_C99 and
+# DW_LANG_C11.
+C_LANGUAGES = set([0x1, 0x2, 0xc, 0x1d])
+
+def is_C_CU(top):
+    """ Whether the CU with the top DIE `top` is written in C.
+    """
+    return ("DW_AT_language" in top.attributes and
+            top.attributes["DW_AT_language"].value in C_LANGUAGES)
+
+def may_contain(tag, child_tags, interesting_tags):
+    """ Whether a DIE with `tag` may have descendants with any of the
+        `interesting_tags`, given the possible `child_tags` of each tag.
+    """
+    if tag not in child_tags:
+        return True
+    return any(child in interesting_tags or may_contain(child, child_tags, interesting_tags)
+               for child in child_tags[tag])
+
+# DIE reading
+#
+# pyelftools decodes every attribute of every DIE it parses, resolving strings
+# and copying blocks, while the visitors only read a handful. DIEReader instead
+# works out once per abbreviation where each attribute lives, and decodes an
+# attribute only when it's looked up.
+
+# struct formats of the fixed-size attribute forms, where "addr" and "offset"
+# stand for the CU's address and offset sizes.
+FIXED_FORMS = {
+    "DW_FORM_addr": "addr",
+    "DW_FORM_data1": "B",
+    "DW_FORM_data2": "H",
+    "DW_FORM_data4": "I",
+    "DW_FORM_data8": "Q",
+    "DW_FORM_ref1": "B",
+    "DW_FORM_ref2": "H",
+    "DW_FORM_ref4": "I",
+    "DW_FORM_ref8": "Q",
+    "DW_FORM_ref_sig8": "Q",
+    "DW_FORM_flag": "B",
+    "DW_FORM_flag_present": "",
+    "DW_FORM_strp": "offset",
+    "DW_FORM_sec_offset": "offset",
+    "DW_FORM_ref_addr": "offset",
+    "DW_FORM_GNU_ref_alt": "offset",
+    "DW_FORM_GNU_strp_alt": "offset"
+}
+
+UNSIGNED_FORMATS = {1: "B", 2: "H", 4: "I", 8: "Q"}
+
+# How to step over each variable-size form: as a LEB128 number, a NUL
+# terminated string, or a block whose length is a one, two or four byte or
+# ULEB128 prefix.
+VARIABLE_FORMS = {
+    "DW_FORM_udata": "leb",
+    "DW_FORM_sdata": "leb",
+    "DW_FORM_ref_udata": "leb",
+    "DW_FORM_string": "string",
+    "DW_FORM_block1": "block1",
+    "DW_FORM_block2": "block2",
+    "DW_FORM_block4": "block4",
+    "DW_FORM_block": "block",
+    "DW_FORM_exprloc": "block",
+    "DW_FORM_indirect": "indirect"
+}
+
+DW_FORM_NAMES = dict((code, name) for name, code in ENUM_DW_FORM.iteritems())
+
+class AbbrevLayout(object):
+    """ An abbreviation compiled into a plan for reading DIEs that use it.
+
+        Attributes are stored back to back, so an attribute's position is fixed
+        relative to the end of the last variable-size attribute before it (or
+        the start of the attributes, for "anchor" 0). `steps` walks over the
+        attributes: an int skips a run of fixed-size ones, and a VARIABLE_FORMS
+        kind steps over a variable-size one, ending the next anchor.
+    """
+
+    __slots__ = ("tag", "has_children", "steps", "fixed_size", "attributes", "names",
+                 "string_attributes")
+
+    def __init__(self, decl, sizes, decoders):
+        self.tag = decl["tag"]
+        self.has_children = decl.has_children()
+        self.steps = []
+        # Name -> (anchor, offset from the anchor, the form's decoder).
+        self.attributes = {}
+        self.names = []
+        # (anchor, offset) of each DW_FORM_strp attribute.
+        self.string_attributes = []
+
+        anchor = 0
+        delta = 0
+        for name, form in decl.iter_attr_specs():
+            if form not in decoders:
+                raise Exception("Unsupported attribute form %s of %s" % (form, name))
+            if name not in self.attributes:
+                self.names.append(name)
+            self.attributes[name] = (anchor, delta, decoders[form])
+            if form == "DW_FORM_strp":
+                self.string_attributes.append((anchor, delta))
+            if form in sizes:
+                delta += sizes[form]
+                if self.steps and self.steps[-1].__class__ is int:
+                    self.steps[-1] += sizes[form]
+                else:
+                    self.steps.append(sizes[form])
+            else:
+                self.steps.append(VARIABLE_FORMS[form])
+                anchor += 1
+                delta = 0
+
+        # The size of the attributes if they're all fixed-size, else None.
+        self.fixed_size = None
+        if anchor == 0:
+            self.fixed_size = delta
+
+class LazyDIE(object):
+    """ A DIE read by DIEReader, with the same fields as pyelftools' DIE that
+        we use, but no links to its parent or children.
+    """
+
+    __slots__ = ("cu", "offset", "abbrev_code", "tag", "has_children", "size", "attributes")
+
+    def is_null(self):
+        return self.abbrev_code == 0
+
+class LazyAttributes(object):
+    """ A read-only mapping of a DIE's attribute names to AttributeValues, which
+        decodes each attribute the first time it's looked up.
+    """
+
+    __slots__ = ("_reader", "_layout", "_anchors", "_values")
+
+    def __init__(self, reader, layout, anchors):
+        self._reader = reader
+        self._layout = layout
+        self._anchors = anchors
+        self._values = None
+
+    def __contains__(self, name):
+        return name in self._layout.attributes
+
+    def __getitem__(self, name):
+        if self._values is None:
+            self._values = {}
+        elif name in self._values:
+            return self._values[name]
+        anchor, delta, decode = self._layout.attributes[name]
+        value = self._values[name] = decode(name, self._anchors[anchor] + delta)
+        return value
+
+    def get(self, name, default=None):
+        if name in self._layout.attributes:
+            return self[name]
+        return default
+
+    def __iter__(self):
+        return iter(self._layout.names)
+
+    def __len__(self):
+        return len(self._layout.names)
+
+    def keys(self):
+        return list(self._layout.names)
+
+    def itervalues(self):
+        return (self[name] for name in self._layout.names)
+
+    def iteritems(self):
+        return ((name, self[name]) for name in self._layout.names)
+
+    def raw_string_offsets(self):
+        """ The .debug_str offsets of the DW_FORM_strp attributes, without
+            reading the strings.
+        """
+        unpack_from = self._reader.unpack_offset
+        return [unpack_from(self._reader.data, self._anchors[anchor] + delta)[0]
+                for anchor, delta in self._layout.string_attributes]
+
+class DIEReader(object):
+    """ Reads the DIEs of one CU from a copy of its bytes.
+
+        Each form gets a decoder, built once, that turns the bytes at a position
+        into the AttributeValue pyelftools would produce (fixed-size forms
+        through a precompiled struct.Struct), and each abbreviation is compiled
+        into an AbbrevLayout the first time a DIE uses it. The one difference
+        is DW_FORM_flag_present, whose value is True rather than pyelftools'
+        empty string, like DW_FORM_flag's when set.
+    """
+
+    def __init__(self, dwarf, cu):
+        self.dwarf = dwarf
+        self.cu = cu
+        self.data = read_section_range(dwarf.debug_info_sec, cu.cu_offset, CU_end(cu) - cu.cu_offset)
+        self._abbrevs = cu.get_abbrev_table()
+
+        # DWARF 2 has address-sized DW_FORM_ref_addr.
+        offset_size = cu.structs.dwarf_format / 8
+        ref_addr_size = cu["address_size"] if cu["version"] == 2 else offset_size
+        format_sizes = {"addr": cu["address_size"], "offset": offset_size}
+        formats = dict((form, UNSIGNED_FORMATS.get(format_sizes.get(fmt), fmt))
+                       for form, fmt in FIXED_FORMS.iteritems())
+        formats["DW_FORM_ref_addr"] = UNSIGNED_FORMATS[ref_addr_size]
+        self.unpack_offset = struct.Struct("<" + UNSIGNED_FORMATS[offset_size]).unpack_from
+
+        self._sizes = {}
+        self._decoders = {}
+        for form, fmt in formats.iteritems():
+            layout = struct.Struct("<" + fmt)
+            self._sizes[form] = layout.size
+            self._decoders[form] = self._fixed_decoder(form, layout)
+        for form in VARIABLE_FORMS:
+            self._decoders[form] = self._variable_decoder(form)
+
+        self._layouts = {}
+        self._strings = {}
+
+    def read_DIE(self, offset):
+        """ Read the DIE at the .debug_info `offset`, without decoding any of its
+            attributes yet.
+        """
+        data = self.data
+        start = offset - self.cu.cu_offset
+        code = ord(data[start])
+        if code < 0x80:
+            position = start + 1
+        else:
+            code, position = decode_uleb128(data, start)
+
+        entry = LazyDIE()
+        entry.cu = self.cu
+        entry.offset = offset
+        entry.abbrev_code = code
+        if code == 0:
+            entry.tag = None
+            entry.has_children = False
+            entry.attributes = {}
+            entry.size = position - start
+            return entry
+
+        layout = self._layouts.get(code) or self._layout(code)
+        anchors = [position]
+        if layout.fixed_size is not None:
+            position += layout.fixed_size
+        else:
+            position = self._step_over_attributes(layout, position, anchors)
+
+        entry.tag = layout.tag
+        entry.has_children = layout.has_children
+        entry.attributes = LazyAttributes(self, layout, anchors)
+        entry.size = position - start
+        return entry
+
+    def _step_over_attributes(self, layout, position, anchors):
+        # Return the position just past the attributes, appending the anchors.
+        data = self.data
+        for step in layout.steps:
+            if step.__class__ is int:
+                position += step
                 continue
-            # Looking for a range of addresses in two consecutive states that
-            # contain the required address.
-            if prevstate and prevstate.address <= address < entry.state.address:
-                filename = lineprog['file_entry'][prevstate.file - 1].name
-                line = prevstate.line
-                column = prevstate.column
-                return {
-                    "source": filename,
-                    "line": line,
-                    "column": column
-                }
-            prevstate = entry.state
+            # Short exprlocs and strings are the common cases.
+            if step == "block" and ord(data[position]) < 0x80:
+                position += 1 + ord(data[position])
+            elif step == "string":
+                position = data.index("\0", position) + 1
+            else:
+                position = self._step_over(step, position)
+            anchors.append(position)
+        return position
+
+    def skip_children(self, offset):
+        """ Return the .debug_info offset just past the children that start at
+            `offset` and the number of DIEs among them, stepping over their
+            attributes without reading any.
+        """
+        data = self.data
+        base = self.cu.cu_offset
+        position = offset - base
+        depth = 1
+        count = 0
+        while depth:
+            code, position = decode_uleb128(data, position)
+            if code == 0:
+                depth -= 1
+                continue
+            count += 1
+            layout = self._layouts.get(code) or self._layout(code)
+            if layout.fixed_size is not None:
+                position += layout.fixed_size
+            else:
+                for step in layout.steps:
+                    if step.__class__ is int:
+                        position += step
+                    else:
+                        position = self._step_over(step, position)
+            if layout.has_children:
+                depth += 1
+        return position + base, count
+
+    def _layout(self, code):
+        layout = AbbrevLayout(self._abbrevs.get_abbrev(code), self._sizes, self._decoders)
+        self._layouts[code] = layout
+        return layout
+
+    def _string_at(self, offset):
+        if offset not in self._strings:
+            self._strings[offset] = self.dwarf.get_string_from_table(offset)
+        return self._strings[offset]
+
+    def _fixed_decoder(self, form, layout):
+        # A function of (name, position in the CU's bytes) -> AttributeValue.
+        data = self.data
+        base = self.cu.cu_offset
+        unpack_from = layout.unpack_from
+        string_at = self._string_at
+
+        if form == "DW_FORM_flag_present":
+            def decode(name, position):
+                return AttributeValue(name, form, True, True, base + position)
+        elif form == "DW_FORM_flag":
+            def decode(name, position):
+                raw_value, = unpack_from(data, position)
+                return AttributeValue(name, form, raw_value != 0, raw_value, base + position)
+        elif form == "DW_FORM_strp":
+            def decode(name, position):
+                raw_value, = unpack_from(data, position)
+                return AttributeValue(name, form, string_at(raw_value), raw_value, base + position)
+        else:
+            def decode(name, position):
+                raw_value, = unpack_from(data, position)
+                return AttributeValue(name, form, raw_value, raw_value, base + position)
+        return decode
+
+    def _variable_decoder(self, form):
+        data = self.data
+        base = self.cu.cu_offset
+        kind = VARIABLE_FORMS[form]
+        block_bounds = self._block_bounds
+        decoders = self._decoders
+        indirect_form = self._indirect_form
+
+        if form == "DW_FORM_sdata":
+            def decode(name, position):
+                value = decode_sleb128(data, position)[0]
+                return AttributeValue(name, form, value, value, base + position)
+        elif kind == "leb":
+            def decode(name, position):
+                value = decode_uleb128(data, position)[0]
+                return AttributeValue(name, form, value, value, base + position)
+        elif kind == "string":
+            def decode(name, position):
+                value = data[position:data.index("\0", position)]
+                return AttributeValue(name, form, value, value, base + position)
+        elif kind == "indirect":
+            def decode(name, position):
+                code, value_position = decode_uleb128(data, position)
+                value = decoders[indirect_form(code)](name, value_position)
+                return value._replace(offset=base + position)
+        else:
+            def decode(name, position):
+                start, end = block_bounds(kind, position)
+                value = map(ord, data[start:end])
+                return AttributeValue(name, form, value, value, base + position)
+        return decode
+
+    def _indirect_form(self, code):
+        form = DW_FORM_NAMES.get(code, code)
+        if form not in self._decoders:
+            raise Exception("Unsupported attribute form %s" % form)
+        return form
+
+    def _block_bounds(self, kind, position):
+        # The (start, end) of a block's contents, after its length.
+        data = self.data
+        if kind == "block1":
+            return position + 1, position + 1 + ord(data[position])
+        if kind == "block2":
+            return position + 2, position + 2 + struct.unpack_from("<H", data, position)[0]
+        if kind == "block4":
+            return position + 4, position + 4 + struct.unpack_from("<I", data, position)[0]
+        size, position = decode_uleb128(data, position)
+        return position, position + size
+
+    def _step_over(self, kind, position):
+        data = self.data
+        if kind == "leb":
+            while ord(data[position]) & 0x80:
+                position += 1
+            return position + 1
+        if kind == "string":
+            return data.index("\0", position) + 1
+        if kind == "indirect":
+            code, position = decode_uleb128(data, position)
+            form = self._indirect_form(code)
+            if form in self._sizes:
+                return position + self._sizes[form]
+            return self._step_over(VARIABLE_FORMS[form], position)
+        return self._block_bounds(kind, position)[1]
+
+class DIEIndex(object):
+    """ Finds the DIE at any .debug_info offset, whichever CU it is in, as
+        DW_FORM_ref_addr references can point into other CUs (after LTO, or
+        dsymutil's uniquing of types).
+
+        The CU holding an offset is found by bisecting the CUs' start offsets,
+        which are only listed once an offset outside the CU at hand is looked
+        up. Each CU's DIEs are read by its own DIEReader and kept by offset as
+        they're first asked for. Only the most recently used CUs' readers and
+        DIEs are kept, so a run of cross-CU references doesn't pile up copies
+        of all of .debug_info.
+    """
+
+    MAX_CUS = 8
+
+    def __init__(self, dwarf):
+        self.dwarf = dwarf
+        self._starts = None
+        self._cus = None
+        # CU offset -> (CU offset, DIEReader, {offset: DIE}), least recently
+        # used first, and the most recently used of them.
+        self._entries = collections.OrderedDict()
+        self._last = None
+
+    def reader_for(self, cu):
+        """ The DIEReader for `cu`.
+        """
+        return self._entry_for(cu)[1]
+
+    def DIE_at(self, offset, cu=None):
+        """ Return the DIE at the .debug_info `offset`, looking in `cu` first if
+            given. Raise ValueError if no CU holds the offset.
+        """
+        if cu is None or not cu.cu_die_offset <= offset < CU_end(cu):
+            cu = self.CU_at(offset)
+        _, reader, dies = self._entry_for(cu)
+        entry = dies.get(offset)
+        if entry is None:
+            entry = dies[offset] = reader.read_DIE(offset)
+        return entry
+
+    def CU_at(self, offset):
+        """ Return the CU whose DIEs span the .debug_info `offset`.
+        """
+        if self._starts is None:
+            # iter_CUs goes through .debug_info in order, so these are sorted.
+            self._cus = list(self.dwarf.iter_CUs())
+            self._starts = array.array("L", (cu.cu_offset for cu in self._cus))
+        i = bisect.bisect_right(self._starts, offset) - 1
+        if i < 0 or not self._cus[i].cu_die_offset <= offset < CU_end(self._cus[i]):
+            raise ValueError("No die with offset=%r" % offset)
+        return self._cus[i]
+
+    def _entry_for(self, cu):
+        entry = self._last
+        if entry is None or entry[0] != cu.cu_offset:
+            entry = self._entries.pop(cu.cu_offset, None)
+            if entry is None:
+                entry = (cu.cu_offset, DIEReader(self.dwarf, cu), {})
+                if len(self._entries) >= self.MAX_CUS:
+                    self._entries.popitem(last=False)
+            self._entries[cu.cu_offset] = entry
+            self._last = entry
+        return entry
+
+class ScopeIndex(object):
+    """ Answers "which is the innermost scope containing this address" in
+        O(log n), from the "ranges" of a list of scopes numbered in pre-order.
+
+        The ranges are cut into elementary segments, each labelled with the
+        innermost scope covering it. Scopes containing an address are all
+        ancestors of one another, so the innermost is the one with the highest
+        (pre-order) index.
+    """
+
+    def __init__(self, scopes):
+        starts = collections.defaultdict(list)
+        ends = collections.defaultdict(list)
+        for index, scope in enumerate(scopes):
+            for start, end in scope.get("ranges", ()):
+                if start < end:
+                    starts[start].append(index)
+                    ends[end].append(index)
+
+        self._starts = array.array("L")
+        self._scopes = array.array("l")
+
+        # Max-heap of active scope indices, with lazy deletion.
+        active = collections.Counter()
+        heap = []
+        for point in sorted(set(starts) | set(ends)):
+            for index in ends.get(point, ()):
+                active[index] -= 1
+            for index in starts.get(point, ()):
+                active[index] += 1
+                heapq.heappush(heap, -index)
+            while heap and active[-heap[0]] <= 0:
+                heapq.heappop(heap)
+
+            innermost = -heap[0] if heap else 0
+            if self._scopes and self._scopes[-1] == innermost:
+                continue
+            self._starts.append(point)
+            self._scopes.append(innermost)
+
+    def innermost_scope_at(self, address):
+        """ Return the index of the innermost scope containing `address`, or 0
+            (the global scope) if there is none.
+        """
+        i = bisect.bisect_right(self._starts, address) - 1
+        if i < 0:
+            return 0
+        return self._scopes[i]
+
+# Location expressions
+#
+# A binding's "location" is None when unknown; an int N for the common
+# DW_OP_fbreg -N, i.e. N bytes below the frame base; otherwise a list of
+# [operation, operands...] with the "DW_OP_" prefix dropped, or, for a location
+# list, {"list": [{"start", "end", "location"}, ...]}.
+
+# DW_AT_location forms that hold a .debug_loc offset rather than an expression.
+LOCATION_LIST_FORMS = set([
+    "DW_FORM_sec_offset",
+    "DW_FORM_data4",
+    "DW_FORM_data8"
+])
+
+DW_OP_NAMES = dict(DW_OP_opcode2name)
+DW_OP_NAMES.update({
+    0x9e: "DW_OP_implicit_value",
+    0x9f: "DW_OP_stack_value"
+})
+
+FIXED_OPERANDS = {
+    "u1": struct.Struct("<B"),
+    "s1": struct.Struct("<b"),
+    "u2": struct.Struct("<H"),
+    "s2": struct.Struct("<h"),
+    "u4": struct.Struct("<I"),
+    "s4": struct.Struct("<i"),
+    "u8": struct.Struct("<Q"),
+    "s8": struct.Struct("<q")
+}
+
+# Operand encodings of each operation that has any: the FIXED_OPERANDS, ULEB128
+# or SLEB128, "addr" and "offset" for the CU's address and offset sizes, and
+# "block" for a ULEB128 length and that many bytes, read as an unsigned
+# little-endian number.
+DW_OP_OPERANDS = {
+    0x03: ("addr",),
+    0x08: ("u1",),
+    0x09: ("s1",),
+    0x0a: ("u2",),
+    0x0b: ("s2",),
+    0x0c: ("u4",),
+    0x0d: ("s4",),
+    0x0e: ("u8",),
+    0x0f: ("s8",),
+    0x10: ("uleb",),
+    0x11: ("sleb",),
+    0x15: ("u1",),
+    0x23: ("uleb",),
+    0x28: ("s2",),
+    0x2f: ("s2",),
+    0x90: ("uleb",),
+    0x91: ("sleb",),
+    0x92: ("uleb", "sleb"),
+    0x93: ("uleb",),
+    0x94: ("u1",),
+    0x95: ("u1",),
+    0x98: ("u2",),
+    0x99: ("u4",),
+    0x9a: ("offset",),
+    0x9d: ("uleb", "uleb"),
+    0x9e: ("block",)
+}
+for opcode in xrange(0x70, 0x90):
+    DW_OP_OPERANDS[opcode] = ("sleb",)
+
+def decode_sleb128(data, offset):
+    """ Decode a SLEB128 number from the byte string `data` at `offset` and
+        return (value, offset just past it).
+    """
+    value, end = decode_uleb128(data, offset)
+    if ord(data[end - 1]) & 0x40:
+        value -= 1 << (7 * (end - offset))
+    return value, end
+
+def decode_location_expression(data, address_size, offset_size):
+    """ Decode the location expression in the byte string `data` into a list of
+        [operation, operands...], or return None if it uses an operation we
+        don't know the operands of. The targets of DW_OP_skip and DW_OP_bra are
+        counted in operations rather than bytes.
+    """
+    try:
+        ops, op_offsets = decode_location_ops(data, address_size, offset_size)
+    except (IndexError, struct.error):
+        # Truncated.
+        return None
+    if ops is None or op_offsets[-1] != len(data):
+        # An unknown operation, or a block running past the end.
+        return None
+
+    for index, op in enumerate(ops):
+        if op[0] in ("skip", "bra"):
+            target = op_offsets[index + 1] + op[1]
+            if target not in op_offsets:
+                return None
+            op[1] = op_offsets.index(target) - (index + 1)
+    return ops
+
+def decode_location_ops(data, address_size, offset_size):
+    """ Decode `data` into (ops, offset of each op and of the end), or
+        (None, None) if it uses an operation we don't know the operands of.
+    """
+    ops = []
+    op_offsets = []
+    offset = 0
+    while offset < len(data):
+        op_offsets.append(offset)
+        opcode = ord(data[offset])
+        offset += 1
+        if opcode not in DW_OP_NAMES:
+            return None, None
+        op = [DW_OP_NAMES[opcode][len("DW_OP_"):]]
+        for operand in DW_OP_OPERANDS.get(opcode, ()):
+            if operand == "uleb":
+                value, offset = decode_uleb128(data, offset)
+            elif operand == "sleb":
+                value, offset = decode_sleb128(data, offset)
+            elif operand == "block":
+                size, offset = decode_uleb128(data, offset)
+                value = 0
+                for byte in reversed(data[offset:offset + size]):
+                    value = value << 8 | ord(byte)
+                offset += size
+            else:
+                if operand == "addr":
+                    operand = "u%d" % address_size
+                elif operand == "offset":
+                    operand = "u%d" % offset_size
+                layout = FIXED_OPERANDS[operand]
+                value, = layout.unpack_from(data, offset)
+                offset += layout.size
+            op.append(value)
+        ops.append(op)
+    op_offsets.append(offset)
+    return ops, op_offsets
+
+class LocationDecoder(object):
+    """ Turns DW_AT_location attributes into binding locations, reading location
+        lists from .debug_loc. The same few expressions make up most variables'
+        locations, so decoded expressions are memoized by their bytes.
+    """
+
+    def __init__(self, dwarf):
+        self.dwarf = dwarf
+        self._location_lists = None
+        self._expressions = {}
+
+    def location_for(self, cu, attribute, base_address, extents=None):
+        """ Return the location described by the DW_AT_location `attribute` of a
+            DIE in `cu`, whose base address is `base_address`. The result may be
+            shared, and must not be modified. The (start, end) offsets of a
+            location list read are added to `extents`, if given.
+        """
+        if attribute.form in LOCATION_LIST_FORMS:
+            return self._location_list(cu, attribute.value, base_address, extents)
+        return self._expression_location(cu, attribute.value)
+
+    def _expression_location(self, cu, expression):
+        data = "".join(map(chr, expression))
+        key = (cu["address_size"], cu.structs.dwarf_format, data)
+        if key in self._expressions:
+            return self._expressions[key]
+
+        location = decode_location_expression(data, cu["address_size"],
+                                              cu.structs.dwarf_format / 8)
+        if location is not None and len(location) == 1 and location[0][0] == "fbreg":
+            location = -location[0][1]
+        self._expressions[key] = location
+        return location
+
+    def _location_list(self, cu, offset, base_address, extents):
+        if self._location_lists is None:
+            self._location_lists = self.dwarf.location_lists()
+            if self._location_lists is None:
+                return None
+
+        location_list = self._location_lists.get_location_list_at_offset(offset)
+        if extents is not None:
+            extents.add((offset, self._location_lists.stream.tell()))
+
+        # Entries are relative to the CU's base address, until a base address
+        # selection entry replaces it.
+        entries = []
+        for entry in location_list:
+            if hasattr(entry, "base_address"):
+                base_address = entry.base_address
+            else:
+                entries.append({
+                    "start": base_address + entry.begin_offset,
+                    "end": base_address + entry.end_offset,
+                    "location": self._expression_location(cu, entry.loc_expr)
+                })
+        return {"list": entries}
+
+def location_at(location, address):
+    """ Return the expression in effect at `address` for a binding location,
+        choosing from its location list if it has one.
+    """
+    if not isinstance(location, dict):
+        return location
+    for entry in location["list"]:
+        if entry["start"] <= address < entry["end"]:
+            return entry["location"]
     return None
 
-# TODO: really shouldn't be using linear search
-# TODO: send PR upstream
-def get_DIE_by_offset(cu, offset):
-    for die in cu.iter_DIEs():
-        if die.offset == offset + cu.cu_offset:
-            return die
-    raise ValueError("No die with offset=%r" % offset)
+BINARY_OPERATORS = {
+    "and": lambda a, b: a & b,
+    "div": lambda a, b: abs(a) // abs(b) * (1 if (a < 0) == (b < 0) else -1),
+    "minus": lambda a, b: a - b,
+    "mod": lambda a, b: a % b,
+    "mul": lambda a, b: a * b,
+    "or": lambda a, b: a | b,
+    "plus": lambda a, b: a + b,
+    "shl": lambda a, b: a << b,
+    "shr": lambda a, b: (a & 0xffffffffffffffff) >> b,
+    "shra": lambda a, b: a >> b,
+    "xor": lambda a, b: a ^ b,
+    "eq": lambda a, b: int(a == b),
+    "ge": lambda a, b: int(a >= b),
+    "gt": lambda a, b: int(a > b),
+    "le": lambda a, b: int(a <= b),
+    "lt": lambda a, b: int(a < b),
+    "ne": lambda a, b: int(a != b)
+}
+
+def evaluate_location(location, frame_base=None, read_register=None, read_memory=None):
+    """ Evaluate a binding location expression (not a location list; see
+        location_at) and return ("memory", address), ("register", number) or
+        ("value", value).
+
+        `frame_base` is the value of the enclosing function's frame base,
+        `read_register(number)` returns a register's value and
+        `read_memory(address, size)` the unsigned number stored at an address;
+        they are only needed by expressions that use them. Composite locations
+        (DW_OP_piece) and DWARF procedure calls aren't supported.
+    """
+    if location is None:
+        raise Exception("No location to evaluate")
+    if isinstance(location, (int, long)):
+        location = [["fbreg", -location]]
+
+    stack = []
+    result = "memory"
+    pc = 0
+    while pc < len(location):
+        op = location[pc]
+        name = op[0]
+        pc += 1
+
+        if name in BINARY_OPERATORS:
+            b = stack.pop()
+            stack.append(BINARY_OPERATORS[name](stack.pop(), b))
+        elif name.startswith("lit"):
+            stack.append(int(name[len("lit"):]))
+        elif name.startswith("const") or name == "addr":
+            stack.append(op[1])
+        elif name.startswith("reg"):
+            if pc != len(location):
+                raise Exception("DW_OP_%s must end a location expression" % name)
+            return ("register", op[1] if name == "regx" else int(name[len("reg"):]))
+        elif name.startswith("breg"):
+            if name == "bregx":
+                stack.append(read_register(op[1]) + op[2])
+            else:
+                stack.append(read_register(int(name[len("breg"):])) + op[1])
+        elif name == "fbreg":
+            if frame_base is None:
+                raise Exception("DW_OP_fbreg needs the frame base")
+            stack.append(frame_base + op[1])
+        elif name == "deref":
+            stack.append(read_memory(stack.pop(), None))
+        elif name == "deref_size":
+            stack.append(read_memory(stack.pop(), op[1]))
+        elif name == "dup":
+            stack.append(stack[-1])
+        elif name == "drop":
+            stack.pop()
+        elif name == "over":
+            stack.append(stack[-2])
+        elif name == "pick":
+            stack.append(stack[-1 - op[1]])
+        elif name == "swap":
+            stack[-1], stack[-2] = stack[-2], stack[-1]
+        elif name == "rot":
+            stack[-1], stack[-2], stack[-3] = stack[-2], stack[-3], stack[-1]
+        elif name == "abs":
+            stack.append(abs(stack.pop()))
+        elif name == "neg":
+            stack.append(-stack.pop())
+        elif name == "not":
+            stack.append(~stack.pop())
+        elif name == "plus_uconst":
+            stack.append(stack.pop() + op[1])
+        elif name in ("skip", "bra"):
+            if name == "skip" or stack.pop() != 0:
+                pc += op[1]
+        elif name == "nop":
+            pass
+        elif name == "stack_value":
+            result = "value"
+        elif name == "implicit_value":
+            return ("value", op[1])
+        else:
+            raise Exception("Can't evaluate DW_OP_%s" % name)
+
+    if not stack:
+        raise Exception("Location expression left an empty stack")
+    return (result, stack[-1])
+
+# Streaming JSON output
+
+JSON_INDENT = 2
+
+# What json.dumps puts between items when given an indent, on Python 2.
+JSON_ITEM_SEPARATOR = ", "
+
+def json_newline(depth):
+    return "\n" + " " * (JSON_INDENT * depth)
+
+def encode_json_item(value, depth):
+    """ Encode `value` as json.dumps(..., indent=JSON_INDENT) would when it is
+        nested `depth` levels deep in a larger document.
+    """
+    return json.dumps(value, indent=JSON_INDENT).replace("\n", json_newline(depth))
+
+def write_json_list(out, encoded_items, depth):
+    """ Write a JSON list, nested `depth` levels deep, whose items have already
+        been encoded at depth + 1.
+    """
+    empty = True
+    for item in encoded_items:
+        out.write("[" if empty else JSON_ITEM_SEPARATOR)
+        out.write(json_newline(depth + 1) + item)
+        empty = False
+    out.write("[]" if empty else json_newline(depth) + "]")
+
+# Compact binary output
+#
+# The same model as the JSON dump, laid out as:
+#
+#   magic, version
+#   string table: count, then (length, UTF-8 bytes) for each string
+#   files: count, then a string for each
+#   types: count, then a TYPE_RECORD for each
+#   scopes: count, then for each: flags, [name], [parent, [start], [end],
+#           ranges count, then (low, high - low) for each range],
+#           bindings count, then (name, type, location) for each binding
+#
+# where start and end are (file, line, column), and a binding location is a
+# LOCATION_* kind followed by: a frame offset; an operation count, then
+# (name, operand count, operands) for each; or an entry count, then
+# (start, end - start, location) for each location list entry.
+#
+# Every integer outside a TYPE_RECORD is a ULEB128 varint (zigzag encoded where
+# it may be negative), strings are indices into the string table, and the
+# optional "parent" of a type is stored plus one so that zero means absent.
+
+BINARY_MAGIC = "KGDI"
+BINARY_VERSION = 4
+
+TYPE_RECORD = struct.Struct("<II")
+
+SCOPE_HAS_NAME = 1
+SCOPE_HAS_PARENT = 2
+SCOPE_HAS_START = 4
+SCOPE_HAS_END = 8
+
+LOCATION_NONE = 0
+LOCATION_FRAME_OFFSET = 1
+LOCATION_EXPRESSION = 2
+LOCATION_LIST = 3
+
+def encode_uleb128(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+def decode_uleb128(data, offset):
+    """ Decode a ULEB128 number from the byte string `data` at `offset` and
+        return (value, offset just past it).
+    """
+    value = 0
+    shift = 0
+    while True:
+        byte = ord(data[offset])
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+def encode_zigzag(value):
+    return encode_uleb128(value << 1 if value >= 0 else ~value << 1 | 1)
+
+def decode_zigzag(data, offset):
+    value, offset = decode_uleb128(data, offset)
+    return (value >> 1) ^ -(value & 1), offset
+
+def write_binary_dump(data, out):
+    """ Write a DebugInfo.as_dict() model to the file object `out` in the
+        compact binary format.
+    """
+    strings = []
+    string_indices = {}
+
+    def intern(s):
+        if s not in string_indices:
+            string_indices[s] = len(strings)
+            strings.append(s)
+        return string_indices[s]
+
+    def encode_string(s):
+        return encode_uleb128(intern(s))
+
+    def encode_location(location):
+        return (encode_uleb128(location["file"]) +
+                encode_uleb128(location["line"]) +
+                encode_uleb128(location["column"]))
+
+    def encode_binding_location(location):
+        if location is None:
+            return encode_uleb128(LOCATION_NONE)
+        if isinstance(location, (int, long)):
+            return encode_uleb128(LOCATION_FRAME_OFFSET) + encode_zigzag(location)
+        if isinstance(location, dict):
+            fields = [encode_uleb128(LOCATION_LIST), encode_uleb128(len(location["list"]))]
+            for entry in location["list"]:
+                fields.append(encode_uleb128(entry["start"]))
+                fields.append(encode_uleb128(entry["end"] - entry["start"]))
+                fields.append(encode_binding_location(entry["location"]))
+            return "".join(fields)
+        fields = [encode_uleb128(LOCATION_EXPRESSION), encode_uleb128(len(location))]
+        for op in location:
+            fields.append(encode_string(op[0]))
+            fields.append(encode_uleb128(len(op) - 1))
+            fields.extend(encode_zigzag(operand) for operand in op[1:])
+        return "".join(fields)
+
+    files = [encode_string(f) for f in data["files"]]
+
+    types = [TYPE_RECORD.pack(intern(t["kind"]), t["parent"] + 1 if "parent" in t else 0)
+             for t in data["types"]]
+
+    scopes = []
+    for scope in data["scopes"]:
+        flags = 0
+        fields = []
+        if scope["name"] is not None:
+            flags |= SCOPE_HAS_NAME
+            fields.append(encode_string(scope["name"]))
+        if "parent" in scope:
+            flags |= SCOPE_HAS_PARENT
+            fields.append(encode_uleb128(scope["parent"]))
+            if scope["start"] is not None:
+                flags |= SCOPE_HAS_START
+                fields.append(encode_location(scope["start"]))
+            if scope["end"] is not None:
+                flags |= SCOPE_HAS_END
+                fields.append(encode_location(scope["end"]))
+            fields.append(encode_uleb128(len(scope["ranges"])))
+            for low, high in scope["ranges"]:
+                fields.append(encode_uleb128(low) + encode_uleb128(high - low))
+        bindings = scope["bindings"]
+        fields.append(encode_uleb128(len(bindings)))
+        for name, binding in bindings.iteritems():
+            fields.append(encode_string(name))
+            fields.append(encode_uleb128(binding["type"]))
+            fields.append(encode_binding_location(binding["location"]))
+        scopes.append(chr(flags) + "".join(fields))
+
+    out.write(BINARY_MAGIC + chr(BINARY_VERSION))
+    out.write(encode_uleb128(len(strings)))
+    for s in strings:
+        if isinstance(s, unicode):
+            s = s.encode("utf-8")
+        out.write(encode_uleb128(len(s)) + s)
+    out.write(encode_uleb128(len(files)))
+    out.write("".join(files))
+    out.write(encode_uleb128(len(types)))
+    out.write("".join(types))
+    out.write(encode_uleb128(len(scopes)))
+    for scope in scopes:
+        out.write(scope)
+
+def read_binary_dump(stream):
+    """ Read a dump written by write_binary_dump back into the same dict model
+        that DebugInfo.as_dict() returns.
+    """
+    data = stream.read()
+    if data[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+        raise Exception("Not a binary debug info dump")
+    offset = len(BINARY_MAGIC)
+    version = ord(data[offset])
+    if version != BINARY_VERSION:
+        raise Exception("Unsupported binary dump version: %d" % version)
+    offset += 1
+
+    count, offset = decode_uleb128(data, offset)
+    strings = []
+    for _ in xrange(count):
+        length, offset = decode_uleb128(data, offset)
+        strings.append(data[offset:offset + length])
+        offset += length
+
+    def read_string(offset):
+        index, offset = decode_uleb128(data, offset)
+        return strings[index], offset
+
+    def read_location(offset):
+        file_index, offset = decode_uleb128(data, offset)
+        line, offset = decode_uleb128(data, offset)
+        column, offset = decode_uleb128(data, offset)
+        return {"file": file_index, "line": line, "column": column}, offset
+
+    def read_binding_location(offset):
+        kind, offset = decode_uleb128(data, offset)
+        if kind == LOCATION_NONE:
+            return None, offset
+        if kind == LOCATION_FRAME_OFFSET:
+            return decode_zigzag(data, offset)
+        count, offset = decode_uleb128(data, offset)
+        if kind == LOCATION_LIST:
+            entries = []
+            for _ in xrange(count):
+                start, offset = decode_uleb128(data, offset)
+                size, offset = decode_uleb128(data, offset)
+                location, offset = read_binding_location(offset)
+                entries.append({"start": start, "end": start + size, "location": location})
+            return {"list": entries}, offset
+        ops = []
+        for _ in xrange(count):
+            name, offset = read_string(offset)
+            num_operands, offset = decode_uleb128(data, offset)
+            op = [name]
+            for _ in xrange(num_operands):
+                operand, offset = decode_zigzag(data, offset)
+                op.append(operand)
+            ops.append(op)
+        return ops, offset
+
+    count, offset = decode_uleb128(data, offset)
+    files = []
+    for _ in xrange(count):
+        filename, offset = read_string(offset)
+        files.append(filename)
+
+    count, offset = decode_uleb128(data, offset)
+    types = []
+    for _ in xrange(count):
+        kind, parent = TYPE_RECORD.unpack_from(data, offset)
+        offset += TYPE_RECORD.size
+        type_ = {"kind": strings[kind]}
+        if parent:
+            type_["parent"] = parent - 1
+        types.append(type_)
+
+    count, offset = decode_uleb128(data, offset)
+    scopes = []
+    for _ in xrange(count):
+        flags = ord(data[offset])
+        offset += 1
+        scope = {"name": None}
+        if flags & SCOPE_HAS_NAME:
+            scope["name"], offset = read_string(offset)
+        if flags & SCOPE_HAS_PARENT:
+            scope["parent"], offset = decode_uleb128(data, offset)
+            scope["start"] = scope["end"] = None
+            if flags & SCOPE_HAS_START:
+                scope["start"], offset = read_location(offset)
+            if flags & SCOPE_HAS_END:
+                scope["end"], offset = read_location(offset)
+            num_ranges, offset = decode_uleb128(data, offset)
+            ranges = []
+            for _ in xrange(num_ranges):
+                low, offset = decode_uleb128(data, offset)
+                size, offset = decode_uleb128(data, offset)
+                ranges.append([low, low + size])
+            scope["ranges"] = ranges
+        bindings = {}
+        num_bindings, offset = decode_uleb128(data, offset)
+        for _ in xrange(num_bindings):
+            name, offset = read_string(offset)
+            type_index, offset = decode_uleb128(data, offset)
+            location, offset = read_binding_location(offset)
+            bindings[name] = {"location": location, "type": type_index}
+        scope["bindings"] = bindings
+        scopes.append(scope)
+
+    return {
+        "types": types,
+        "scopes": scopes,
+        "files": files
+    }
 
 # Visitor API
 
 START_VISITORS = {}
 END_VISITORS = {}
 
+# The (start, end) visitors of a tag nobody visits.
+NO_VISITORS = (None, None)
+
 def visitor(tag, when="start"):
     """ Decorator to register the decorated function to be called whenever we visit
         an entry of type `tag`.
@@ -144,6 +1710,29 @@ def visitor(tag, when="start"):
 
     return decorator
 
+class Bindings(dict):
+    """ A scope's bindings, name -> binding. Everything reads it as a plain
+        dict, but it also remembers the order in which names were first bound.
+        A dict's iteration order, and so our JSON output, depends on that
+        order, which pickling or marshalling a dict loses.
+    """
+
+    __slots__ = ("names",)
+
+    def __init__(self):
+        dict.__init__(self)
+        self.names = []
+
+    def __setitem__(self, name, binding):
+        if name not in self:
+            self.names.append(name)
+        dict.__setitem__(self, name, binding)
+
+    def pairs(self):
+        """ The [name, binding] pairs, in the order the names were bound.
+        """
+        return [[name, self[name]] for name in self.names]
+
 class DebugInfo(object):
     """ Accumulates the subset of debugging info we care about from DWARF and
         massages it into a format that's easier for us to handle.
@@ -151,67 +1740,370 @@ class DebugInfo(object):
 
     # Public API
 
-    def __init__(self, dwarf):
+    def __init__(self, dwarf, spool=None, collect_inputs=False, DIE_index=None,
+                 line_table=None, locations=None):
         self.dwarf = dwarf
+        # A LineTableIndex, built on first use unless one is shared with us.
+        self._line_table = line_table
+        self._locations = locations or LocationDecoder(dwarf)
+
+        # Tag -> (start visitor, end visitor), bound to this instance.
+        self._visitors = self._compile_visitors()
+        # Abbreviation table offset -> {abbreviation code: (start visitor,
+        # end visitor)}, filled in as codes are first seen.
+        self._dispatch_tables = {}
 
         self._types = []
         self._types_by_offset = {}
 
+        # Source file names, which scope locations refer to by index.
+        self._files = []
+        self._file_indices = {}
+
+        # Reads the DIEs of the CUs being visited and of those their DIEs
+        # reference, which may be shared with other DebugInfos.
+        self._DIE_index = DIE_index or DIEIndex(dwarf)
+        # The base address of the CU currently being visited.
+        self._base_address = 0
+
+        # The .debug_str offsets used by the DIEs we've parsed, and the (start,
+        # end) offsets of the .debug_loc and .debug_ranges lists we've read,
+        # if wanted.
+        self.string_offsets = set() if collect_inputs else None
+        self.location_lists = set() if collect_inputs else None
+        self.range_lists = set() if collect_inputs else None
+        # The offsets of the CUs that DIEs referenced by offset were found in.
+        self.referenced_CUs = set()
+
+        # DIEs visited, and subtrees (and their bytes) skipped as holding
+        # nothing any visitor is interested in.
+        self.visited_DIEs = 0
+        self.skipped_subtrees = 0
+        self.skipped_bytes = 0
+
         global_scope = {
             "name": "Global",
-            "bindings": {}
+            "bindings": Bindings()
         }
         self._scopes = [global_scope]
-        self._current_scope_stack = [global_scope]
+        # Built on the first scopes_at() query.
+        self._scope_index = None
+        # Indices of the scopes enclosing the current DIE. Indices count spilled
+        # scopes too, so scope i > 0 lives at self._scopes[i - self._spilled_scopes].
+        self._current_scope_stack = [0]
 
-    def as_json(self, **kwargs):
-        return json.dumps({
+        # Finished scopes are encoded into `spool`, a temporary file, by
+        # spill_scopes() so they needn't stay in memory until the end.
+        self._spool = spool
+        self._spilled_scopes = 0
+
+    def as_dict(self):
+        if self._spilled_scopes:
+            raise Exception("Scopes have been spilled, use write_json")
+        return {
+            "types": self._types,
+            "scopes": self._scopes,
+            "files": self._files
+        }
+
+    def as_portable_dict(self):
+        """ Like as_dict(), but with each scope's bindings as a list of
+            [name, binding] pairs in the order they were bound, which survives
+            pickling and marshalling, and with the .debug_info offset of each
+            type's DIE. This is what merge() takes.
+        """
+        if self._spilled_scopes:
+            raise Exception("Scopes have been spilled, use write_json")
+        type_offsets = [None] * len(self._types)
+        for offset, index in self._types_by_offset.iteritems():
+            type_offsets[index] = offset
+        return {
             "types": self._types,
-            "scopes": self._scopes
-        }, **kwargs)
+            "type_offsets": type_offsets,
+            "scopes": [dict(scope, bindings=scope["bindings"].pairs()) for scope in self._scopes],
+            "files": self._files
+        }
+
+    def as_json(self, **kwargs):
+        return json.dumps(self.as_dict(), **kwargs)
+
+    def write_json(self, out):
+        """ Write the same text as `as_json(indent=JSON_INDENT)` to the file
+            object `out`, encoding one type or scope at a time instead of
+            building the whole string in memory.
+        """
+        # A dict literal with the same keys as as_dict(), so that they come out
+        # in the order json.dumps would use.
+        sections = {
+            "types": self._iter_encoded_types,
+            "scopes": self._iter_encoded_scopes,
+            "files": self._iter_encoded_files
+        }
+        out.write("{")
+        for i, (key, iter_encoded) in enumerate(sections.iteritems()):
+            if i:
+                out.write(JSON_ITEM_SEPARATOR)
+            out.write(json_newline(1) + json.dumps(key) + ": ")
+            write_json_list(out, iter_encoded(), 1)
+        out.write(json_newline(0) + "}")
+
+    def scopes_at(self, address):
+        """ Return the indices of the scopes containing `address`, innermost
+            first and ending with the global scope. Only valid while no scopes
+            have been spilled.
+        """
+        if self._spilled_scopes:
+            raise Exception("Scopes have been spilled, can't query them")
+        if self._scope_index is None:
+            self._scope_index = ScopeIndex(self._scopes)
+
+        chain = [self._scope_index.innermost_scope_at(address)]
+        while chain[-1] != 0:
+            chain.append(self._scopes[chain[-1]]["parent"])
+        return chain
+
+    def scope(self, index):
+        return self._scopes[index]
+
+    def file(self, index):
+        """ Return the name of the source file with the "file" index `index`.
+        """
+        return self._files[index]
+
+    def spill_scopes(self):
+        """ Encode every finished scope into the spool and drop it from memory.
+            Does nothing without a spool, or while any scope but the global one
+            is still open.
+        """
+        if self._spool is None or len(self._current_scope_stack) > 1:
+            return
+        for scope in self._scopes[1:]:
+            marshal.dump(encode_json_item(scope, 2), self._spool)
+        self._spilled_scopes += len(self._scopes) - 1
+        del self._scopes[1:]
 
-    def visit(self, cu, entry, indent=""):
-        """ Traverse the DIE tree and accumulate its information.
+    def merge(self, other):
+        """ Append the types and scopes from another DebugInfo's
+            `as_portable_dict()`, accumulated over CUs that this one has not
+            visited, remapping their type, scope and file indices into our
+            tables. The other global scope's bindings are folded into ours.
+
+            Types whose DIEs we already have a type for, as when one CU refers to
+            another's, are mapped onto ours rather than added again. With that,
+            and bindings added in the order they were bound, merging each CU's
+            results in CU order gives the same output as visiting the CUs.
+        """
+        # Other type index -> ours. A type's parent always comes before it.
+        type_indices = []
+        for type_, offset in zip(other["types"], other["type_offsets"]):
+            if offset in self._types_by_offset:
+                type_indices.append(self._types_by_offset[offset])
+                continue
+            type_ = dict(type_)
+            if "parent" in type_:
+                type_["parent"] = type_indices[type_["parent"]]
+            self._types_by_offset[offset] = len(self._types)
+            type_indices.append(len(self._types))
+            self._types.append(type_)
+
+        # The other global scope is index 0 and maps onto ours, so its first
+        # real scope lands at our next free index.
+        scope_base = self._next_scope_index() - 1
+
+        other_files = other["files"]
+
+        def remap_location(location):
+            if location is None:
+                return None
+            location = dict(location)
+            location["file"] = self._intern_file(other_files[location["file"]])
+            return location
+
+        def remap_bindings(pairs, remapped):
+            for name, binding in pairs:
+                binding = dict(binding)
+                binding["type"] = type_indices[binding["type"]]
+                remapped[name] = binding
+            return remapped
+
+        other_scopes = other["scopes"]
+        remap_bindings(other_scopes[0]["bindings"], self._scopes[0]["bindings"])
+        for scope in other_scopes[1:]:
+            parent = scope["parent"]
+            # Built with the same key order as add_scope, so that merged
+            # output serializes identically to a serial run's.
+            self._scopes.append({
+                "start": remap_location(scope["start"]),
+                "end": remap_location(scope["end"]),
+                "ranges": scope["ranges"],
+                "bindings": remap_bindings(scope["bindings"], Bindings()),
+                "name": scope["name"],
+                "parent": parent + scope_base if parent != 0 else 0
+            })
+        self._scope_index = None
+
+    def visit(self, cu):
+        """ Traverse the CU's DIE tree and accumulate its information, skipping
+            subtrees that can't hold anything a visitor is interested in.
         """
-        self._call_visitor(entry, START_VISITORS, cu, indent)
-        for child in entry.iter_children():
-            self.visit(cu, child, indent + "    ")
-        self._call_visitor(entry, END_VISITORS, cu, indent)
+        # DIEs are read one at a time in pre-order, with an explicit stack of
+        # the (DIE, end visitor) pairs whose children we're in. A DIE's
+        # abbreviation code determines its tag, so visitors are looked up by
+        # code in the CU's dispatch table.
+        reader = self._DIE_index.reader_for(cu)
+        string_offsets = self.string_offsets
+        top = reader.read_DIE(cu.cu_die_offset)
+        self._base_address = CU_base_address(top)
+        dispatch = self._dispatch_table(cu, top)
+
+        stack = []
+        offset = cu.cu_die_offset
+        end_offset = CU_end(cu)
+        while offset < end_offset:
+            entry = top if offset == top.offset else reader.read_DIE(offset)
+            offset += entry.size
+            if entry.abbrev_code == 0:
+                # The end of the innermost open DIE's children, or padding.
+                if stack:
+                    parent, end = stack.pop()
+                    if end is not None:
+                        end(cu, parent)
+                continue
+
+            self.visited_DIEs += 1
+            if string_offsets is not None:
+                string_offsets.update(entry.attributes.raw_string_offsets())
+            try:
+                start, end, descend = dispatch[entry.abbrev_code]
+            except KeyError:
+                start, end, descend = dispatch[entry.abbrev_code] = self._dispatch_entry(entry.tag, top)
+
+            if start is not None:
+                start(cu, entry)
+            if entry.has_children:
+                if descend:
+                    stack.append((entry, end))
+                    continue
+                if "DW_AT_sibling" in entry.attributes:
+                    next_offset = reference_offset(cu, entry.attributes["DW_AT_sibling"])
+                else:
+                    next_offset, _ = reader.skip_children(offset)
+                self.skipped_subtrees += 1
+                self.skipped_bytes += next_offset - offset
+                offset = next_offset
+            if end is not None:
+                end(cu, entry)
+
+        while stack:
+            parent, end = stack.pop()
+            if end is not None:
+                end(cu, parent)
 
     # Privates
 
     def _current_scope(self):
-        return self._current_scope_stack[-1]
+        index = self._current_scope_stack[-1]
+        if index == 0:
+            return self._scopes[0]
+        return self._scopes[index - self._spilled_scopes]
+
+    def _next_scope_index(self):
+        return len(self._scopes) + self._spilled_scopes
+
+    def _iter_encoded_types(self):
+        for type_ in self._types:
+            yield encode_json_item(type_, 2)
 
-    def _call_visitor(self, entry, visitors, cu, indent):
-        if entry.tag in visitors:
-            method_name = visitors[entry.tag]
-            method = getattr(self, method_name)
-            method(cu, entry, indent)
+    def _iter_encoded_files(self):
+        for filename in self._files:
+            yield encode_json_item(filename, 2)
+
+    def _iter_encoded_scopes(self):
+        yield encode_json_item(self._scopes[0], 2)
+        if self._spool is not None:
+            self._spool.seek(0)
+            for _ in xrange(self._spilled_scopes):
+                yield marshal.load(self._spool)
+        for scope in self._scopes[1:]:
+            yield encode_json_item(scope, 2)
+
+    def _get_location(self, address):
+        """ Return the {"file", "line", "column"} location of `address`, where
+            "file" indexes our file table, or None if it has no line info.
+        """
+        if self._line_table is None:
+            self._line_table = LineTableIndex(self.dwarf)
+        location = self._line_table.location_for(address)
+        if location is None:
+            return None
+        return {
+            "file": self._intern_file(location["source"]),
+            "line": location["line"],
+            "column": location["column"]
+        }
+
+    def _intern_file(self, filename):
+        if filename not in self._file_indices:
+            self._file_indices[filename] = len(self._files)
+            self._files.append(filename)
+        return self._file_indices[filename]
+
+    def _get_referenced_DIE(self, cu, attribute):
+        # `cu` is the CU of the DIE holding `attribute`; the referenced DIE's
+        # own references are relative to its CU, `entry.cu`.
+        entry = self._DIE_index.DIE_at(reference_offset(cu, attribute), cu)
+        if self.string_offsets is not None:
+            self.string_offsets.update(entry.attributes.raw_string_offsets())
+        self.referenced_CUs.add(entry.cu.cu_offset)
+        return entry
+
+    def _compile_visitors(self):
+        visitors = {}
+        for tag in set(START_VISITORS) | set(END_VISITORS):
+            start = end = None
+            if tag in START_VISITORS:
+                start = getattr(self, START_VISITORS[tag])
+            if tag in END_VISITORS:
+                end = getattr(self, END_VISITORS[tag])
+            visitors[tag] = (start, end)
+        return visitors
+
+    def _dispatch_table(self, cu, top):
+        # CUs sharing an abbreviation table share its codes, though not
+        # necessarily their language.
+        key = (cu["debug_abbrev_offset"], is_C_CU(top))
+        if key not in self._dispatch_tables:
+            self._dispatch_tables[key] = {}
+        return self._dispatch_tables[key]
+
+    def _dispatch_entry(self, tag, top):
+        # (start visitor, end visitor, whether to descend into children)
+        start, end = self._visitors.get(tag, NO_VISITORS)
+        child_tags = C_CHILD_TAGS if is_C_CU(top) else CHILD_TAGS
+        return start, end, may_contain(tag, child_tags, self._visitors)
 
     def _get_or_create_type(self, cu, type_entry):
         """ Get or create the type object for the given type entry DIE, and return its
             index into our types list.
         """
         # TODO: save size, name, members, etc
-        # TODO: don't use linear search
 
         if type_entry.offset in self._types_by_offset:
-            existing_type = self._types_by_offset[type_entry.offset]
-            return self._types.index(existing_type)
+            return self._types_by_offset[type_entry.offset]
 
         new_type = {
             "kind": type_entry.tag.replace("DW_TAG_", "")
         }
 
         if "DW_AT_type" in type_entry.attributes:
-            parent_offset = type_entry.attributes["DW_AT_type"].value
-            parent = self._get_or_create_type(cu, get_DIE_by_offset(cu, parent_offset))
+            parent_entry = self._get_referenced_DIE(type_entry.cu, type_entry.attributes["DW_AT_type"])
+            parent = self._get_or_create_type(parent_entry.cu, parent_entry)
             new_type["parent"] = parent
 
-        self._types_by_offset[type_entry.offset] = new_type
+        index = len(self._types)
+        self._types_by_offset[type_entry.offset] = index
         self._types.append(new_type)
-        return len(self._types) - 1
+        return index
 
     # Visitor Implementations
 
@@ -219,15 +2111,19 @@ class DebugInfo(object):
     @visitor("lexical_block")
     @visitor("try_block")
     @visitor("catch_block")
-    def add_scope(self, cu, entry, indent):
+    def add_scope(self, cu, entry):
         # TODO types of scopes (function vs block, etc). should be part of name?
         # TODO add return type
 
-        low_pc = entry.attributes["DW_AT_low_pc"].value
-        start = get_location(self.dwarf, low_pc)
+        ranges = get_DIE_ranges(self.dwarf, entry, self._base_address, self.range_lists)
+        ranges = [(low, high) for low, high in ranges if low < high]
 
-        high_pc = entry.attributes["DW_AT_high_pc"].value
-        end = get_location(self.dwarf, high_pc)
+        # Declarations and abstract instances have no code, and so no
+        # locations. The end is the scope's last byte; high_pc is one past it.
+        start = end = None
+        if ranges:
+            start = self._get_location(min(low for low, _ in ranges))
+            end = self._get_location(max(high for _, high in ranges) - 1)
 
         name = None
         if "DW_AT_name" in entry.attributes:
@@ -236,38 +2132,53 @@ class DebugInfo(object):
         scope = {
             "start": start,
             "end": end,
-            "bindings": {},
+            "ranges": [[low, high] for low, high in ranges],
+            "bindings": Bindings(),
             "name": name,
-            # TODO: don't use linear search
-            "parent": self._scopes.index(self._current_scope())
+            "parent": self._current_scope_stack[-1]
         }
 
-        self._current_scope_stack.append(scope)
+        self._current_scope_stack.append(self._next_scope_index())
         self._scopes.append(scope)
+        self._scope_index = None
 
     @visitor("subprogram", "end")
     @visitor("lexical_block", "end")
     @visitor("try_block", "end")
     @visitor("catch_block", "end")
-    def end_scope(self, cu, entry, indent):
+    def end_scope(self, cu, entry):
         self._current_scope_stack.pop()
 
     @visitor("variable")
     @visitor("formal_parameter")
     @visitor("constant")
-    def add_variable(self, cu, entry, indent):
+    def add_variable(self, cu, entry):
         # TODO type of variable (constant, parameter, normal, ...)
 
-        name = entry.attributes["DW_AT_name"].value
+        attributes = entry.attributes
+        type_cu = cu
+        if "DW_AT_abstract_origin" in attributes:
+            # Concrete instances of inlined functions' variables, which are the
+            # ones optimized code gives location lists, leave their name and
+            # type to the abstract instance, which may be in another CU.
+            origin_entry = self._get_referenced_DIE(cu, attributes["DW_AT_abstract_origin"])
+            origin = origin_entry.attributes
+            if "DW_AT_type" not in attributes:
+                type_cu = origin_entry.cu
+            attributes = dict((name, attributes[name] if name in attributes else origin[name])
+                              for name in ("DW_AT_name", "DW_AT_type", "DW_AT_location")
+                              if name in attributes or name in origin)
+        if "DW_AT_name" not in attributes or "DW_AT_type" not in attributes:
+            return
+
+        name = attributes["DW_AT_name"].value
         location = None
-        if "DW_AT_location" in entry.attributes:
-            loc_val = entry.attributes["DW_AT_location"].value
-            if len(loc_val) == 2 and loc_val[0] == 145:
-                location = 128 - loc_val[1]
+        if "DW_AT_location" in attributes:
+            location = self._locations.location_for(cu, attributes["DW_AT_location"],
+                                                    self._base_address, self.location_lists)
 
-        type_offset = entry.attributes["DW_AT_type"].value
-        type_entry = get_DIE_by_offset(cu, type_offset)
-        type_index = self._get_or_create_type(cu, type_entry)
+        type_entry = self._get_referenced_DIE(type_cu, attributes["DW_AT_type"])
+        type_index = self._get_or_create_type(type_entry.cu, type_entry)
 
         self._current_scope()["bindings"][name] = {
             "location": location,
@@ -284,20 +2195,990 @@ class DebugInfo(object):
     @visitor("subrange_type")
     @visitor("array_type")
     @visitor("typedef")
-    def add_type(self, cu, entry, indent):
+    def add_type(self, cu, entry):
         self._get_or_create_type(cu, entry)
 
-def main():
-    filename = sys.argv[1]
-    sections = read_dwarf_sections(filename)
-    dwarf = dwarfinfo.DWARFInfo(CONFIG, **sections)
+# Output cache
+
+# Part of every output cache key; bump it whenever the output changes.
+OUTPUT_CACHE_VERSION = "2"
+
+def binary_cache_key(filename):
+    """ Identify a Mach-O file by its LC_UUID, falling back to a hash of its
+        DWARF segment's contents when it has no UUID.
+    """
+    with open(filename, "rb") as handle:
+        uuid = read_uuid(handle)
+        if uuid is not None:
+            return "uuid-" + uuid.encode("hex")
+
+        digest = hashlib.sha1()
+        for segname, sections in iter_segments(handle):
+            if segname == DWARF_SEGNAME:
+                for sectname, offset, size in sections:
+                    digest.update(sectname)
+                    handle.seek(offset)
+                    digest.update(handle.read(size))
+        return "sha1-" + digest.hexdigest()
+
+def output_cache_key(args):
+    """ The key `args`' dump is cached under: the binary's identity, and the
+        output format and version.
+    """
+    return "%s.%s.v%s" % (binary_cache_key(args.filename), args.format, OUTPUT_CACHE_VERSION)
+
+class OutputCache(object):
+    """ A directory of finished dumps, keyed by binary identity and output
+        format, that evicts the least recently used entries once it grows past
+        `max_bytes`. Hit and miss counts persist in the directory alongside,
+        once save_stats() adds this run's to them.
+
+        The directory is listed at most once, when its size is first needed;
+        after that, entries' ages and sizes are tracked in memory.
+    """
+
+    STATS_FILE = "stats.json"
+    ENTRY_SUFFIX = ".dump"
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # This run's hits and misses, not yet saved.
+        self._hits = 0
+        self._misses = 0
+        # Entry name -> (mtime, size), and their total size, once listed.
+        self._entries = None
+        self._total_bytes = 0
+
+    def get(self, key):
+        """ Return an open file of the cached output for `key`, or None.
+        """
+        path = self._path(key)
+        try:
+            cached = open(path, "rb")
+        except IOError:
+            self._misses += 1
+            return None
+        # Entries are aged by mtime, which unlike atime is reliably updated.
+        os.utime(path, None)
+        self._hits += 1
+        name = os.path.basename(path)
+        if self._entries is not None and name in self._entries:
+            self._entries[name] = (time.time(), self._entries[name][1])
+        return cached
+
+    def peek(self, key):
+        """ Like get(), but without counting a hit or miss, or making the entry
+            any younger.
+        """
+        try:
+            return open(self._path(key), "rb")
+        except IOError:
+            return None
+
+    def put(self, key, write):
+        """ Call `write(out)` to produce the output for `key`, store it, evict
+            older entries as needed and return an open file of the new entry.
+        """
+        path = self._path(key)
+        out = tempfile.NamedTemporaryFile(dir=self.directory, suffix=".tmp", delete=False)
+        try:
+            with out:
+                write(out)
+            os.rename(out.name, path)
+        except:
+            os.remove(out.name)
+            raise
+
+        entries = self._list_entries()
+        name = os.path.basename(path)
+        if name in entries:
+            self._total_bytes -= entries[name][1]
+        size = os.path.getsize(path)
+        entries[name] = (time.time(), size)
+        self._total_bytes += size
+        self._evict(keep=name)
+        return open(path, "rb")
+
+    def stats(self):
+        stats = self._saved_stats()
+        stats["hits"] += self._hits
+        stats["misses"] += self._misses
+        stats["entries"] = len(self._list_entries())
+        stats["bytes"] = self._total_bytes
+        return stats
+
+    def save_stats(self):
+        """ Add this run's hits and misses to the counts in the directory.
+        """
+        stats = self._saved_stats()
+        stats["hits"] += self._hits
+        stats["misses"] += self._misses
+        with open(os.path.join(self.directory, self.STATS_FILE), "w") as f:
+            json.dump(stats, f)
+        self._hits = self._misses = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.ENTRY_SUFFIX)
+
+    def _saved_stats(self):
+        stats = {"hits": 0, "misses": 0}
+        try:
+            with open(os.path.join(self.directory, self.STATS_FILE)) as f:
+                stats.update(json.load(f))
+        except (IOError, ValueError):
+            pass
+        return stats
+
+    def _list_entries(self):
+        if self._entries is None:
+            self._entries = {}
+            for name in os.listdir(self.directory):
+                if name.endswith(self.ENTRY_SUFFIX):
+                    st = os.stat(os.path.join(self.directory, name))
+                    self._entries[name] = (st.st_mtime, st.st_size)
+            self._total_bytes = sum(size for _, size in self._entries.itervalues())
+        return self._entries
+
+    def _evict(self, keep):
+        if self._total_bytes <= self.max_bytes:
+            return
+        entries = self._entries
+        for _, name in sorted((mtime, name) for name, (mtime, _) in entries.iteritems()):
+            if self._total_bytes <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                # Already evicted by another run.
+                pass
+            self._total_bytes -= entries.pop(name)[1]
+
+# Per-CU result cache
+
+# Part of every CU cache key; bump it whenever the per-CU output changes.
+CU_CACHE_VERSION = "9"
+
+def read_section_range(section, offset, size):
+    section.stream.seek(offset)
+    return section.stream.read(size)
+
+def unit_size(section, offset):
+    """ Size of the DWARF unit (a line program, say) at `offset`, including its
+        initial length field.
+    """
+    length, = struct.unpack("<I", read_section_range(section, offset, 4))
+    if length == 0xffffffff:
+        length, = struct.unpack("<Q", read_section_range(section, offset + 4, 8))
+        return 12 + length
+    return 4 + length
+
+def digest_inputs(dwarf, inputs, keys):
+    """ Digest what a CU's result depends on besides its own cache key, as
+        recorded in `inputs` by visit_CU: the strings and location and range
+        lists it read, and the keys of the other CUs it referenced.
+    """
+    digest = hashlib.sha1()
+    for offset in inputs["string_offsets"]:
+        digest.update(parse_cstring_from_stream(dwarf.debug_str_sec.stream, offset))
+        digest.update("\0")
+    for section, extents in [(dwarf.debug_loc_sec, inputs["location_lists"]),
+                             (dwarf.debug_ranges_sec, inputs["range_lists"])]:
+        if section is None:
+            continue
+        for start, end in extents:
+            digest.update(read_section_range(section, start, end - start))
+    for offset in inputs["referenced_CUs"]:
+        digest.update(str(keys.get(offset)))
+    return digest.hexdigest()
+
+class CUCacheKeys(object):
+    """ Computes the key a CU's results are cached under: a hash of the CU's
+        .debug_info bytes, its abbreviation table and its line program.
+
+        Strings live in the shared .debug_str and are only referenced by offset,
+        so cache entries also record a digest of the strings they used, which
+        must still match for the entry to be reused. Likewise for the location
+        and range lists in .debug_loc and .debug_ranges, and for the keys of any
+        other CUs that the CU's DIEs referenced.
+    """
+
+    def __init__(self, dwarf, cus):
+        self.dwarf = dwarf
+        # Abbreviation tables don't record their size; each runs up to the next
+        # one that a CU uses, or to the end of the section.
+        offsets = sorted(set(cu["debug_abbrev_offset"] for cu in cus))
+        ends = offsets[1:] + [dwarf.debug_abbrev_sec.size]
+        self._abbrev_ends = dict(zip(offsets, ends))
+
+    def key_for(self, cu):
+        dwarf = self.dwarf
+        digest = hashlib.sha1(CU_CACHE_VERSION)
+
+        size = cu["unit_length"] + cu.structs.initial_length_field_size()
+        digest.update(read_section_range(dwarf.debug_info_sec, cu.cu_offset, size))
+
+        abbrev_offset = cu["debug_abbrev_offset"]
+        abbrev_size = self._abbrev_ends[abbrev_offset] - abbrev_offset
+        digest.update(read_section_range(dwarf.debug_abbrev_sec, abbrev_offset, abbrev_size))
+
+        top = top_DIE(cu)
+        if "DW_AT_stmt_list" in top.attributes and dwarf.debug_line_sec is not None:
+            line_offset = top.attributes["DW_AT_stmt_list"].value
+            line_size = unit_size(dwarf.debug_line_sec, line_offset)
+            digest.update(read_section_range(dwarf.debug_line_sec, line_offset, line_size))
+
+        return "cu-" + digest.hexdigest()
+
+def merge_CU_results(args, dwarf, dbg_info, cu_cache):
+    """ Merge every CU's results into `dbg_info` in CU order, reusing entries
+        from `cu_cache` for CUs whose inputs haven't changed and visiting (and
+        caching) the rest. Return the offsets of the CUs that had to be visited,
+        in CU order.
+
+        Each result is merged, and dropped, as soon as its turn comes, so only
+        a few are in memory at once.
+    """
+    cus = list(dwarf.iter_CUs())
+    cache_keys = CUCacheKeys(dwarf, cus)
+
+    # All keys first, as entries are checked against the keys of the CUs
+    # they referenced, which may come later.
+    keys = dict((cu.cu_offset, cache_keys.key_for(cu)) for cu in cus)
+
+    # An entry is a marshalled header, which says whether the entry is still
+    # valid, followed by the marshalled result. Only the headers are read
+    # up front.
+    reusable = set()
+    for cu in cus:
+        cached = cu_cache.get(keys[cu.cu_offset])
+        if cached is None:
+            continue
+        with cached:
+            header = marshal.load(cached)
+        if digest_inputs(dwarf, header["inputs"], keys) == header["digest"]:
+            reusable.add(cu.cu_offset)
+
+    missing = [cu.cu_offset for cu in cus if cu.cu_offset not in reusable]
+    if args.jobs > 1:
+        computed = iter_pooled_results(args, missing)
+    else:
+        indexes = shared_indexes(dwarf) if missing else None
+        computed = ((cu.cu_offset,) + visit_CU(dwarf, cu, indexes)
+                    for cu in cus if cu.cu_offset not in reusable)
+
+    def store(cu_offset, result, inputs):
+        header = {"inputs": inputs, "digest": digest_inputs(dwarf, inputs, keys)}
+
+        def write(out):
+            out.write(marshal.dumps(header))
+            out.write(marshal.dumps(result))
+
+        cu_cache.put(keys[cu_offset], write).close()
+
+    recomputed = []
+    for cu in cus:
+        result = None
+        if cu.cu_offset in reusable:
+            cached = cu_cache.peek(keys[cu.cu_offset])
+            if cached is not None:
+                with cached:
+                    marshal.load(cached)
+                    result = marshal.load(cached)
+            else:
+                # Evicted to make room for the entries stored since.
+                visited = visit_CU(dwarf, cu)
+                store(cu.cu_offset, *visited)
+                result = visited[0]
+                recomputed.append(cu.cu_offset)
+        else:
+            computed_offset, result, inputs = next(computed)
+            store(computed_offset, result, inputs)
+            recomputed.append(computed_offset)
+        dbg_info.merge(result)
+        dbg_info.spill_scopes()
+
+    return recomputed
+
+# Query API
+
+class Symbolicator(object):
+    """ Loads a binary's debug info once and then answers address queries
+        against it, keeping its indexes warm between queries.
+    """
+
+    def __init__(self, filename, use_mmap=False):
+        _, self.dwarf = open_dwarf(filename, use_mmap)
+        self._line_table = LineTableIndex(self.dwarf)
+        self.debug_info = DebugInfo(self.dwarf, line_table=self._line_table)
+        for cu in self.dwarf.iter_CUs():
+            self.debug_info.visit(cu)
+
+    def location_for(self, address):
+        """ Return the {"source", "line", "column"} location of `address`, or
+            None if there is no line info for it.
+        """
+        return self._line_table.location_for(address)
+
+    def locations_for(self, addresses):
+        """ Return the location_for each of `addresses`, resolving them all in
+            one sorted sweep.
+        """
+        return self._line_table.locations_for(addresses)
+
+    def scopes_at(self, address):
+        """ Return the scopes containing `address`, innermost first and ending
+            with the global scope. Their start and end locations name their
+            source file, as location_for's do, rather than index the file
+            table.
+        """
+        scopes = []
+        for i in self.debug_info.scopes_at(address):
+            scope = self.debug_info.scope(i)
+            if scope.get("start") is not None or scope.get("end") is not None:
+                scope = dict(scope)
+                for key in ("start", "end"):
+                    if scope[key] is not None:
+                        scope[key] = self._source_location(scope[key])
+            scopes.append(scope)
+        return scopes
+
+    def bindings_at(self, address):
+        """ Return the bindings visible at `address`, with inner scopes
+            shadowing outer ones, and with location lists narrowed to the
+            expression in effect at `address`.
+        """
+        bindings = {}
+        for scope in reversed(self.scopes_at(address)):
+            bindings.update(scope["bindings"])
+        for name, binding in bindings.iteritems():
+            if isinstance(binding["location"], dict):
+                binding = dict(binding)
+                binding["location"] = location_at(binding["location"], address)
+                bindings[name] = binding
+        return bindings
+
+    def _source_location(self, location):
+        return {
+            "source": self.debug_info.file(location["file"]),
+            "line": location["line"],
+            "column": location["column"]
+        }
+
+    def query(self, line):
+        """ Answer one line of the server protocol, "<command> <address>", with
+            a line of JSON.
+        """
+        try:
+            command, address = line.split()
+            method = self.QUERIES[command]
+            result = method(self, int(address, 0))
+        except (KeyError, ValueError):
+            result = {"error": "expected one of %s followed by an address, got %r" % (
+                ", ".join(sorted(self.QUERIES)), line.strip())}
+        return json.dumps(result)
+
+    QUERIES = {
+        "location": location_for,
+        "scopes": scopes_at,
+        "bindings": bindings_at
+    }
+
+def symbolicate(args, out):
+    """ Read addresses one per line from `args.symbolicate` and write each one's
+        location to `out` as a line of JSON, in the same order.
+    """
+    infile = sys.stdin if args.symbolicate == "-" else open(args.symbolicate)
+    with infile:
+        addresses = [int(line, 0) for line in infile if line.strip()]
+
+    # Resolving a batch only needs the line tables, not a full DebugInfo.
+    _, dwarf = open_dwarf(args.filename, use_mmap=args.mmap)
+    for location in LineTableIndex(dwarf).locations_for(addresses):
+        out.write(json.dumps(location) + "\n")
+
+def serve_lines(symbolicator, infile, outfile):
+    for line in iter(infile.readline, ""):
+        if not line.strip():
+            continue
+        outfile.write(symbolicator.query(line) + "\n")
+        outfile.flush()
+
+def serve_socket(symbolicator, path):
+    """ Answer queries from clients connecting to a Unix socket at `path`, one
+        connection at a time, using the same line protocol as stdin.
+    """
+    class Handler(SocketServer.StreamRequestHandler):
+        def handle(self):
+            serve_lines(symbolicator, self.rfile, self.wfile)
+
+    # Only a socket left behind by an earlier server is ours to replace.
+    if os.path.lexists(path):
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            raise Exception("Not replacing %s, which is not a socket" % path)
+        os.remove(path)
+    server = SocketServer.UnixStreamServer(path, Handler)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(path)
+
+def open_dwarf(filename, use_mmap=False, stats=None):
+    sections = read_dwarf_sections(filename, use_mmap=use_mmap, stats=stats)
+    return sections, dwarfinfo.DWARFInfo(CONFIG, **sections)
+
+# Benchmarks
+#
+# Each compares, on the file given, the way we do something against the
+# way it was done before or against an alternative mode. Run with
+# --benchmark NAME; results go to stderr.
+
+BENCHMARKS = {}
+
+def benchmark(name):
+    """ Decorator to register the decorated function(args, out) as the
+        benchmark `name`.
+    """
+    def decorator(fn):
+        BENCHMARKS[name] = fn
+        return fn
+
+    return decorator
+
+def best_time(fn, *args):
+    """ Call `fn(*args)` three times and return (the fastest time, its
+        result).
+    """
+    best = None
+    for _ in xrange(3):
+        start = time.time()
+        result = fn(*args)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def memory_usage():
+    """ Return this process's peak RSS and current private (anonymous) RSS in
+        KiB. The latter is None where /proc isn't available.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # Bytes, not KiB.
+        peak //= 1024
+    private = None
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("RssAnon:"):
+                    private = int(line.split()[1])
+    except IOError:
+        pass
+    return peak, private
+
+def measure_dump(filename, use_mmap):
+    # Run in a fresh process, so the peak RSS is this dump's alone.
+    args = argparse.Namespace(filename=filename, mmap=use_mmap, format="json",
+                              cu_cache_dir=None, jobs=1, section_stats=False,
+                              visit_stats=False)
+    start = time.time()
+    with open(os.devnull, "w") as out:
+        dump_debug_info(args, out)
+    return (time.time() - start,) + memory_usage()
+
+@benchmark("sections")
+def benchmark_section_loading(args, out):
+    """ Report the wall time, peak RSS and private memory of a JSON dump with
+        each section copied into memory, and with the file memory-mapped.
+        Mapped pages still count towards RSS, but they're backed by the file
+        and can be dropped under memory pressure, unlike private copies.
+    """
+    for name, use_mmap in [("copied", False), ("mmap", True)]:
+        pool = multiprocessing.Pool(1)
+        try:
+            elapsed, peak, private = pool.apply(measure_dump, (args.filename, use_mmap))
+        finally:
+            pool.close()
+            pool.join()
+        print >>out, "%s: %.3fs, peak RSS %d KiB, private RSS %s KiB at exit" % (
+            name, elapsed, peak, "?" if private is None else private)
+
+def spread(items, count):
+    """ Return up to `count` of `items`, picked evenly across the list.
+    """
+    return items[::max(1, len(items) // count)][:count]
+
+def sample_line_addresses(dwarf, count):
+    """ Return up to `count` addresses spread evenly over the rows of the
+        file's line programs, in address order.
+    """
+    addresses = set()
+    for cu in dwarf.iter_CUs():
+        lineprog = line_program_for_CU(dwarf, cu)
+        if lineprog is None:
+            continue
+        for entry in lineprog.get_entries():
+            if entry.state is not None and not entry.state.end_sequence:
+                addresses.add(entry.state.address)
+    return spread(sorted(addresses), count)
+
+def replay_location_for(dwarf, address):
+    # How locations were found before LineTableIndex: by replaying every line
+    # program, afresh, until one has a row covering the address.
+    for cu in dwarf.iter_CUs():
+        lineprog = dwarf.line_program_for_CU(cu)
+        prevstate = None
+        for entry in lineprog.get_entries():
+            if entry.state is None or entry.state.end_sequence:
+                continue
+            if prevstate and prevstate.address <= address < entry.state.address:
+                return {
+                    "source": lineprog["file_entry"][prevstate.file - 1].name,
+                    "line": prevstate.line,
+                    "column": prevstate.column
+                }
+            prevstate = entry.state
+    return None
+
+@benchmark("lines")
+def benchmark_line_lookups(args, out):
+    """ Report the time per address lookup of replaying the line programs and
+        of LineTableIndex, including the time to build the index. Measured on
+        functions.macho from `tests/make_fixtures.py --benchmarks`.
+    """
+    _, dwarf = open_dwarf(args.filename, args.mmap)
+    # Replaying is slow enough that a few addresses make the point.
+    addresses = sample_line_addresses(dwarf, 10000)
+    replayed = spread(addresses, 10)
+
+    def replay():
+        for address in replayed:
+            replay_location_for(dwarf, address)
+
+    def index():
+        line_table = LineTableIndex(dwarf)
+        for address in addresses:
+            line_table.location_for(address)
+
+    for name, lookup, count in [("replay", replay, len(replayed)),
+                                ("LineTableIndex", index, len(addresses))]:
+        best, _ = best_time(lookup)
+        print >>out, "%s: %d lookups in %.3fs, %.3fms/lookup" % (
+            name, count, best, best / max(count, 1) * 1e3)
+
+@benchmark("symbolicate")
+def benchmark_symbolicate(args, out):
+    """ Report the time to find the locations of a batch of addresses with
+        LineTableIndex.locations_for, as --symbolicate does, and with
+        location_for one at a time. The line tables are built beforehand.
+    """
+    _, dwarf = open_dwarf(args.filename, args.mmap)
+    # In no particular order, as they might come from a crash log.
+    addresses = sample_line_addresses(dwarf, 100000)
+    addresses.sort(key=lambda address: hashlib.md5(str(address)).digest())
+
+    line_table = LineTableIndex(dwarf)
+    start = time.time()
+    line_table.locations_for(addresses)
+    print >>out, "building line tables: %.3fs" % (time.time() - start)
+
+    def one_by_one():
+        return [line_table.location_for(address) for address in addresses]
+
+    results = []
+    for name, lookup in [("location_for", one_by_one),
+                         ("locations_for", lambda: line_table.locations_for(addresses))]:
+        best, result = best_time(lookup)
+        results.append(result)
+        print >>out, "%s: %d lookups in %.3fs, %.2fus/lookup" % (
+            name, len(addresses), best, best / max(len(addresses), 1) * 1e6)
+    assert results[0] == results[1]
+
+def iter_DIEs_with_reader(dwarf):
+    """ Yield every DIE in the file, read with DIEReader, in order.
+    """
+    for cu in dwarf.iter_CUs():
+        reader = DIEReader(dwarf, cu)
+        offset = cu.cu_die_offset
+        end = CU_end(cu)
+        while offset < end:
+            entry = reader.read_DIE(offset)
+            offset += entry.size
+            yield entry
+
+@benchmark("types")
+def benchmark_type_lookups(args, out):
+    """ Report the time to find the type index of every DW_AT_type reference
+        in the file from the referenced DIE's offset: by searching the types
+        list for the type's dict, as before, and straight from the offset.
+        Measured on typedefs.macho from `tests/make_fixtures.py --benchmarks`.
+    """
+    _, dwarf = open_dwarf(args.filename, args.mmap)
     dbg_info = DebugInfo(dwarf)
+    for cu in dwarf.iter_CUs():
+        dbg_info.visit(cu)
+    types = dbg_info._types
+    indices = dbg_info._types_by_offset
+    type_dicts = dict((offset, types[index]) for offset, index in indices.iteritems())
+
+    offsets = []
+    for entry in iter_DIEs_with_reader(dwarf):
+        if "DW_AT_type" in entry.attributes:
+            offset = reference_offset(entry.cu, entry.attributes["DW_AT_type"])
+            if offset in indices:
+                offsets.append(offset)
+
+    def search():
+        for offset in offsets:
+            types.index(type_dicts[offset])
+
+    def direct():
+        for offset in offsets:
+            indices[offset]
+
+    for name, lookup in [("list search", search), ("offset -> index", direct)]:
+        best, _ = best_time(lookup)
+        print >>out, "%s: %d lookups among %d types in %.3fs" % (
+            name, len(offsets), len(types), best)
+
+def walk_recursively(reader, entry, indent):
+    # Walk the DIE and its descendants as DebugInfo.visit once did, recursing
+    # into each child with a longer indent. Return the offset past them.
+    offset = entry.offset + entry.size
+    if entry.has_children:
+        while True:
+            child = reader.read_DIE(offset)
+            if child.abbrev_code == 0:
+                return offset + child.size
+            offset = walk_recursively(reader, child, indent + "  ")
+    return offset
+
+def walk_iteratively(reader, cu):
+    # Walk the CU's DIEs as DebugInfo.visit does, with an explicit stack.
+    # Return the deepest nesting seen.
+    stack = []
+    deepest = 0
+    offset = cu.cu_die_offset
+    end_offset = CU_end(cu)
+    while offset < end_offset:
+        entry = reader.read_DIE(offset)
+        offset += entry.size
+        if entry.abbrev_code == 0:
+            if stack:
+                stack.pop()
+            continue
+        if entry.has_children:
+            stack.append(entry)
+            deepest = max(deepest, len(stack))
+    return deepest
+
+@benchmark("traversal")
+def benchmark_DIE_traversal(args, out):
+    """ Report the time to walk every DIE tree recursively and with an
+        explicit stack, and how deeply DIEs nest.
+    """
+    _, dwarf = open_dwarf(args.filename, args.mmap)
+    readers = [(cu, DIEReader(dwarf, cu)) for cu in dwarf.iter_CUs()]
+
+    def recursive():
+        for cu, reader in readers:
+            walk_recursively(reader, reader.read_DIE(cu.cu_die_offset), "")
+
+    def iterative():
+        return max(walk_iteratively(reader, cu) for cu, reader in readers)
+
+    try:
+        best, _ = best_time(recursive)
+        print >>out, "recursive: %.3fs" % best
+    except RuntimeError:
+        print >>out, "recursive: exceeded the recursion limit of %d" % sys.getrecursionlimit()
+    best, deepest = best_time(iterative)
+    print >>out, "explicit stack: %.3fs, deepest nesting %d" % (best, deepest)
+
+@benchmark("dispatch")
+def benchmark_visitor_dispatch(args, out):
+    """ Report the time to find and call the start and end visitors of every
+        DIE: by looking up the DIE's tag and then the visitor's method name, as
+        before, and by abbreviation code in a table of bound methods per
+        abbreviation table, as DebugInfo.visit does. The visitors do nothing
+        and the DIEs are read beforehand, so only dispatch is timed.
+    """
+    _, dwarf = open_dwarf(args.filename, args.mmap)
+    cus = []
+    for entry in iter_DIEs_with_reader(dwarf):
+        if not cus or cus[-1][0] is not entry.cu:
+            cus.append((entry.cu, []))
+        if entry.abbrev_code != 0:
+            cus[-1][1].append(entry)
+
+    calls = []
+    def no_op(self, cu, entry):
+        calls.append(entry)
+    names = set(START_VISITORS.values()) | set(END_VISITORS.values())
+    visitors = type("NoOpVisitors", (object,), dict.fromkeys(names, no_op))()
+
+    def by_name():
+        del calls[:]
+        for cu, entries in cus:
+            for entry in entries:
+                if entry.tag in START_VISITORS:
+                    getattr(visitors, START_VISITORS[entry.tag])(cu, entry)
+                if entry.tag in END_VISITORS:
+                    getattr(visitors, END_VISITORS[entry.tag])(cu, entry)
+        return len(calls)
+
+    bound = {}
+    for tag in set(START_VISITORS) | set(END_VISITORS):
+        bound[tag] = tuple(getattr(visitors, table[tag]) if tag in table else None
+                           for table in (START_VISITORS, END_VISITORS))
+
+    def by_code():
+        del calls[:]
+        tables = {}
+        for cu, entries in cus:
+            dispatch = tables.setdefault(cu["debug_abbrev_offset"], {})
+            for entry in entries:
+                try:
+                    start, end = dispatch[entry.abbrev_code]
+                except KeyError:
+                    start, end = dispatch[entry.abbrev_code] = bound.get(entry.tag, NO_VISITORS)
+                if start is not None:
+                    start(cu, entry)
+                if end is not None:
+                    end(cu, entry)
+        return len(calls)
 
+    count = sum(len(entries) for _, entries in cus)
+    for name, dispatch in [("by tag and method name", by_name),
+                           ("by abbreviation code", by_code)]:
+        best, visits = best_time(dispatch)
+        print >>out, "%s: %d DIEs, %d visits in %.3fs, %.2fus/DIE" % (
+            name, count, visits, best, best / max(count, 1) * 1e6)
+
+def scan_DIEs_with_pyelftools(dwarf):
+    count = 0
+    for cu in dwarf.iter_CUs():
+        for entry in cu.iter_DIEs():
+            count += 1
+    return count
+
+def scan_DIEs_with_reader(dwarf):
+    # Read every DIE and the attributes most visitors look at.
+    count = 0
     for cu in dwarf.iter_CUs():
-        root = cu.get_top_DIE()
-        dbg_info.visit(cu, root)
+        reader = DIEReader(dwarf, cu)
+        offset = cu.cu_die_offset
+        end = CU_end(cu)
+        while offset < end:
+            entry = reader.read_DIE(offset)
+            attributes = entry.attributes
+            if "DW_AT_name" in attributes:
+                attributes["DW_AT_name"]
+            if "DW_AT_type" in attributes:
+                attributes["DW_AT_type"]
+            offset += entry.size
+            count += 1
+    return count
+
+@benchmark("scan")
+def benchmark_DIE_scanning(args, out):
+    """ Report how many DIEs per second pyelftools and DIEReader read from the
+        file, best of three runs each.
+    """
+    _, dwarf = open_dwarf(args.filename, args.mmap)
+    for name, scan in [("pyelftools", scan_DIEs_with_pyelftools),
+                       ("DIEReader", scan_DIEs_with_reader)]:
+        best, count = best_time(scan, dwarf)
+        print >>out, "%s: %d DIEs in %.3fs, %d DIEs/second" % (
+            name, count, best, count / best)
+
+def shared_indexes(dwarf):
+    """ Indexes over the whole file, as DebugInfo keyword arguments, for the
+        DebugInfos that visit_CU creates in one process to share rather than
+        each build anew.
+    """
+    return {
+        "DIE_index": DIEIndex(dwarf),
+        "line_table": LineTableIndex(dwarf),
+        "locations": LocationDecoder(dwarf)
+    }
+
+def visit_CU(dwarf, cu, indexes=None):
+    """ Visit one CU with a fresh DebugInfo. Return its `as_portable_dict()`
+        and what else in the file the result depends on: the sorted .debug_str
+        offsets that the DIEs it parsed refer to, the sorted (start, end)
+        offsets of the location and range lists it read, and the sorted
+        offsets of the other CUs that its DIEs referenced.
+    """
+    dbg_info = DebugInfo(dwarf, collect_inputs=True, **(indexes or {}))
+    dbg_info.visit(cu)
+    inputs = {
+        "string_offsets": sorted(dbg_info.string_offsets),
+        "location_lists": sorted(dbg_info.location_lists),
+        "range_lists": sorted(dbg_info.range_lists),
+        "referenced_CUs": sorted(dbg_info.referenced_CUs - set([cu.cu_offset]))
+    }
+    return dbg_info.as_portable_dict(), inputs
+
+# A process pool worker's (DWARFInfo, {CU offset: CU}, shared_indexes()), set
+# up once per process by init_worker.
+worker_state = None
+
+def init_worker(filename, use_mmap):
+    """ Process pool initializer: open the file afresh, and index it, once for
+        all the CUs the worker will visit.
+    """
+    global worker_state
+    _, dwarf = open_dwarf(filename, use_mmap)
+    cus = dict((cu.cu_offset, cu) for cu in dwarf.iter_CUs())
+    worker_state = (dwarf, cus, shared_indexes(dwarf))
+
+def visit_CUs(cu_offsets):
+    """ Process pool worker: visit the CUs at the given offsets and return a
+        (cu_offset, result, inputs) tuple from visit_CU for each.
+    """
+    dwarf, cus, indexes = worker_state
+    return [(offset,) + visit_CU(dwarf, cus[offset], indexes) for offset in cu_offsets]
+
+def iter_pooled_results(args, cu_offsets):
+    """ Visit the CUs at `cu_offsets` across a pool of `args.jobs` processes,
+        yielding visit_CUs' tuples in CU order.
+    """
+    # Several chunks per process, so one slow CU doesn't hold up the rest;
+    # results come back in chunk order, i.e. in CU order.
+    jobs = split_evenly(cu_offsets, args.jobs * 4)
+    pool = multiprocessing.Pool(args.jobs, init_worker, (args.filename, args.mmap))
+    try:
+        for results in pool.imap(visit_CUs, jobs):
+            for result in results:
+                yield result
+    finally:
+        pool.close()
+        pool.join()
+
+def split_evenly(items, n):
+    """ Split `items` into at most `n` contiguous, similarly sized chunks.
+    """
+    size, extra = divmod(len(items), n)
+    chunks = []
+    start = 0
+    for i in xrange(n):
+        end = start + size + (1 if i < extra else 0)
+        if end > start:
+            chunks.append(items[start:end])
+        start = end
+    return chunks
+
+def dump_debug_info(args, out):
+    """ Read the DWARF from `args.filename` and write it to `out` in
+        `args.format`.
+    """
+    stats = {}
+    sections, dwarf = open_dwarf(args.filename, use_mmap=args.mmap, stats=stats)
+    # The binary writer needs every string up front, so it can't use a spool.
+    spool = tempfile.TemporaryFile() if args.format == "json" else None
+    dbg_info = DebugInfo(dwarf, spool=spool)
+
+    if args.cu_cache_dir:
+        cu_cache = OutputCache(args.cu_cache_dir, args.cache_size)
+        recomputed = merge_CU_results(args, dwarf, dbg_info, cu_cache)
+        cu_cache.save_stats()
+        if args.cache_stats:
+            total = len(list(dwarf.iter_CUs()))
+            print >>sys.stderr, "cu cache: %d of %d CUs reused, %d recomputed" % (
+                total - len(recomputed), total, len(recomputed))
+    elif args.jobs > 1:
+        cu_offsets = [cu.cu_offset for cu in dwarf.iter_CUs()]
+        for _, result, _ in iter_pooled_results(args, cu_offsets):
+            dbg_info.merge(result)
+            dbg_info.spill_scopes()
+    else:
+        for cu in dwarf.iter_CUs():
+            dbg_info.visit(cu)
+            dbg_info.spill_scopes()
+
+    if args.format == "binary":
+        write_binary_dump(dbg_info.as_dict(), out)
+    else:
+        dbg_info.write_json(out)
+        out.write("\n")
+
+    if args.section_stats:
+        print_section_stats(sections, stats, sys.stderr)
+    if args.visit_stats:
+        # Only DIEs visited in this process; not those visited by --jobs
+        # workers or whose CUs came from the cache.
+        print >>sys.stderr, "visited %d DIEs, skipped %d subtrees (%d bytes)" % (
+            dbg_info.visited_DIEs, dbg_info.skipped_subtrees, dbg_info.skipped_bytes)
+
+def main():
+    parser = argparse.ArgumentParser(description="Dump DWARF debug info as JSON.")
+    parser.add_argument("filename")
+    parser.add_argument("--mmap", action="store_true",
+                        help="memory-map the file instead of copying each section")
+    parser.add_argument("--section-stats", action="store_true",
+                        help="report which DWARF sections were read to stderr")
+    parser.add_argument("--visit-stats", action="store_true",
+                        help="report how many DIEs were visited and skipped to stderr")
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help="number of processes to spread compilation units over")
+    parser.add_argument("--format", choices=["json", "binary"], default="json",
+                        help="output format (default: json)")
+    parser.add_argument("--cache-dir",
+                        help="reuse finished output for binaries seen before")
+    parser.add_argument("--cu-cache-dir",
+                        help="reuse results for compilation units that haven't changed")
+    parser.add_argument("--cache-size", type=int, default=1 << 30,
+                        help="evict cached output past this many bytes (default: 1GiB)")
+    parser.add_argument("--cache-stats", action="store_true",
+                        help="report cache hits and misses to stderr")
+    parser.add_argument("--serve", action="store_true",
+                        help="answer 'location|scopes|bindings ADDRESS' queries read from stdin")
+    parser.add_argument("--listen", metavar="SOCKET",
+                        help="answer queries from clients of a Unix socket")
+    parser.add_argument("--symbolicate", metavar="ADDRESSES",
+                        help="print the location of each address listed in this file ('-' for stdin)")
+    parser.add_argument("--benchmark", choices=sorted(BENCHMARKS),
+                        help="compare implementations on the file, reporting to stderr")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        BENCHMARKS[args.benchmark](args, sys.stderr)
+        return
+
+    if args.symbolicate:
+        symbolicate(args, sys.stdout)
+        return
+
+    if args.serve or args.listen:
+        symbolicator = Symbolicator(args.filename, use_mmap=args.mmap)
+        if args.listen:
+            serve_socket(symbolicator, args.listen)
+        else:
+            serve_lines(symbolicator, sys.stdin, sys.stdout)
+        return
+
+    if not args.cache_dir:
+        dump_debug_info(args, sys.stdout)
+        return
+
+    cache = OutputCache(args.cache_dir, args.cache_size)
+    key = output_cache_key(args)
+    cached = cache.get(key)
+    if cached is None:
+        cached = cache.put(key, lambda out: dump_debug_info(args, out))
+    with cached:
+        shutil.copyfileobj(cached, sys.stdout)
+    cache.save_stats()
 
-    print dbg_info.as_json(indent=2)
+    if args.cache_stats:
+        stats = cache.stats()
+        print >>sys.stderr, "cache: %(hits)d hits, %(misses)d misses, %(entries)d entries, %(bytes)d bytes" % stats
 
 if __name__ == "__main__":
     main()
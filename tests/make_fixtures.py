@@ -0,0 +1,134 @@
+#!/usr/bin/env python2.7
+""" Rebuild the fixtures in tests/fixtures from the C sources at the top of the
+    repository. Needs gcc; run from anywhere with:
+
+    python2.7 tests/make_fixtures.py
+
+    gcc builds ELF files rather than Mach-O, so the DWARF sections of the
+    ELF output are repackaged into the __DWARF segment of a Mach-O file.
+
+    With --benchmarks DIRECTORY, it also generates the larger synthetic
+    programs that test.py's --benchmark modes were measured on, and builds
+    them into DIRECTORY. They're too big to commit.
+"""
+import argparse
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+
+from elftools.elf.elffile import ELFFile
+
+from test_kosmograd import ROOT, build_macho
+
+FIXTURES = os.path.join(ROOT, "tests", "fixtures")
+
+def repackage(elf_path, macho_path):
+    with open(elf_path, "rb") as f:
+        elf = ELFFile(f)
+        sections = [("__" + str(s.name[1:]), s.data()) for s in elf.iter_sections()
+                    if s.name.startswith(".debug_")]
+    uuid = hashlib.md5("".join(data for _, data in sections)).digest()
+    with open(macho_path, "wb") as f:
+        f.write(build_macho([("__DWARF", sections)], uuid=uuid))
+
+def build(sources, flags, macho_path, directory):
+    elf_path = os.path.join(directory, "a.out")
+    subprocess.check_call(["gcc", "-gdwarf-4"] + flags + ["-I", ROOT] + sources +
+                          ["-o", elf_path])
+    repackage(elf_path, macho_path)
+
+def write_nested_blocks(directory, depth=1500):
+    """ Write the C source of a function with `depth` nested blocks, each
+        declaring a variable, so that its DIEs nest deeper than Python's
+        recursion limit. Return its path.
+    """
+    path = os.path.join(directory, "nested.c")
+    with open(path, "w") as f:
+        f.write("volatile int sink;\n")
+        f.write("int main(void) {\n")
+        for i in range(depth):
+            f.write("{ int v%d = %d; sink = v%d;\n" % (i, i, i))
+        f.write("}" * depth + "\n")
+        f.write("return 0; }\n")
+    return [path]
+
+def write_many_functions(directory, files=4, functions=250):
+    """ Write the C sources of a program with `files` CUs of `functions`
+        functions each, all with nested blocks, for `--benchmark lines`.
+        Return their paths.
+    """
+    sources = []
+    for i in range(files):
+        path = os.path.join(directory, "functions%d.c" % i)
+        with open(path, "w") as f:
+            f.write("typedef struct { int n; char *name; } T%d;\n" % i)
+            f.write("volatile int sink%d;\n" % i)
+            for j in range(functions):
+                f.write("int function_%d_%d(int a, T%d t) {\n"
+                        "    int s = a + t.n;\n"
+                        "    {\n"
+                        "        int s2 = s * 2;\n"
+                        "        {\n"
+                        "            const int s3 = s2 + 1;\n"
+                        "            sink%d = s3;\n"
+                        "        }\n"
+                        "        sink%d = s2;\n"
+                        "    }\n"
+                        "    return s;\n"
+                        "}\n" % (i, j, i, i, i))
+            if i == 0:
+                f.write("int main(void) { return 0; }\n")
+        sources.append(path)
+    return sources
+
+def write_chained_typedefs(directory, count=3000):
+    """ Write the C source of a CU with `count` typedefs, each a pointer to
+        the one before, and a variable of each, for `--benchmark types`.
+        Return its path.
+    """
+    path = os.path.join(directory, "typedefs.c")
+    with open(path, "w") as f:
+        f.write("typedef int t0;\n")
+        for i in range(1, count):
+            f.write("typedef t%d *t%d;\n" % (i - 1, i))
+        f.write("void f(void) {\n")
+        for i in range(count):
+            f.write("    t%d v%d = 0; (void)v%d;\n" % (i, i, i))
+        f.write("}\n")
+        f.write("int main(void) { f(); return 0; }\n")
+    return [path]
+
+def build_benchmarks(output, directory):
+    build(write_many_functions(directory), ["-O0"], os.path.join(output, "functions.macho"),
+          directory)
+    build(write_chained_typedefs(directory), ["-O0"], os.path.join(output, "typedefs.macho"),
+          directory)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmarks", metavar="DIRECTORY",
+                        help="also build the benchmark programs into DIRECTORY")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        # Optimized code has location lists in .debug_loc and range lists in
+        # .debug_ranges, which unoptimized code doesn't. With link-time
+        # optimization, an extra CU refers to types in hello.c's CU.
+        for flags, name in [(["-O0"], "hello.macho"),
+                            (["-O2"], "hello-O2.macho"),
+                            (["-O2", "-flto"], "hello-lto.macho")]:
+            # hello.c first, so that changes to goodbye.c leave hello.c's CU be.
+            build([os.path.join(ROOT, "hello.c"), os.path.join(ROOT, "goodbye.c")], flags,
+                  os.path.join(FIXTURES, name), directory)
+        build(write_nested_blocks(directory), ["-O0"], os.path.join(FIXTURES, "nested.macho"),
+              directory)
+        if args.benchmarks:
+            build_benchmarks(args.benchmarks, directory)
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main()
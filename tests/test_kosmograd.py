@@ -0,0 +1,649 @@
+#!/usr/bin/env python2.7
+""" Tests for test.py. Run with:
+
+    python2.7 -m unittest discover -s tests
+"""
+import sys
+import unittest
+
+if sys.version_info[0] != 2:
+    raise unittest.SkipTest("test.py only runs on Python 2")
+
+import StringIO
+import argparse
+import imp
+import json
+import marshal
+import os
+import shutil
+import struct
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Loaded under another name, as "test" is also the name of the standard
+# library's regression test package.
+kosmograd = imp.load_source("kosmograd", os.path.join(ROOT, "test.py"))
+
+# hello.c and goodbye.c built with gcc, unoptimized, optimized and with
+# link-time optimization; see make_fixtures.py.
+HELLO = os.path.join(ROOT, "tests", "fixtures", "hello.macho")
+HELLO_O2 = os.path.join(ROOT, "tests", "fixtures", "hello-O2.macho")
+HELLO_LTO = os.path.join(ROOT, "tests", "fixtures", "hello-lto.macho")
+FIXTURES = [HELLO, HELLO_O2, HELLO_LTO]
+# main() in 1500 nested blocks.
+NESTED = os.path.join(ROOT, "tests", "fixtures", "nested.macho")
+
+def build_macho(segments, uuid=None, magic=0xfeedfacf):
+    """ Lay out a little-endian 64-bit Mach-O file with an LC_UUID, if `uuid`
+        is given, and an LC_SEGMENT_64 for each (segname, [(sectname, data)])
+        of `segments`, followed by the sections' contents.
+    """
+    commands = []
+    if uuid is not None:
+        commands.append(struct.pack("<II16s", 0x1b, 24, uuid))
+    header_size = 32 + sum(len(c) for c in commands) + sum(72 + 80 * len(sections)
+                                                           for _, sections in segments)
+
+    contents = ""
+    for segname, sections in segments:
+        records = ""
+        for sectname, data in sections:
+            records += struct.pack("<16s16sQQIIIIIIII", sectname, segname, 0, len(data),
+                                   header_size + len(contents), 0, 0, 0, 0, 0, 0, 0)
+            contents += data
+        commands.append(struct.pack("<II16sQQQQiiII", 0x19, 72 + len(records), segname,
+                                    0, 0, 0, 0, 7, 5, len(sections), 0) + records)
+
+    header = struct.pack("<IiiIIIII", magic, 0x01000007, 3, 0xa, len(commands),
+                         sum(len(c) for c in commands), 0, 0)
+    return header + "".join(commands) + contents
+
+class TempDirTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_file(self, data, name="binary"):
+        path = os.path.join(self.directory, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def open_file(self, data):
+        return open(self.write_file(data), "rb")
+
+class TestMachO(TempDirTestCase):
+    SEGMENTS = [
+        ("__TEXT", []),
+        ("__DWARF", [("__debug_info", "info bytes"),
+                     ("__debug_str", "str\0"),
+                     ("__apple_names", "ignored")])
+    ]
+
+    def test_iter_segments(self):
+        data = build_macho(self.SEGMENTS)
+        with self.open_file(data) as handle:
+            segments = list(kosmograd.iter_segments(handle))
+
+        self.assertEqual([name for name, _ in segments], ["__TEXT", "__DWARF"])
+        self.assertEqual(segments[0][1], [])
+        names = [name for name, _, _ in segments[1][1]]
+        self.assertEqual(names, ["__debug_info", "__debug_str", "__apple_names"])
+        for (name, offset, size), (_, contents) in zip(segments[1][1], self.SEGMENTS[1][1]):
+            self.assertEqual(data[offset:offset + size], contents)
+
+    def test_read_uuid(self):
+        uuid = "0123456789abcdef"
+        with self.open_file(build_macho(self.SEGMENTS, uuid=uuid)) as handle:
+            self.assertEqual(kosmograd.read_uuid(handle), uuid)
+        with self.open_file(build_macho(self.SEGMENTS)) as handle:
+            self.assertIsNone(kosmograd.read_uuid(handle))
+
+    def test_read_dwarf_sections(self):
+        path = self.write_file(build_macho(self.SEGMENTS))
+        for use_mmap in (False, True):
+            stats = {}
+            sections = kosmograd.read_dwarf_sections(path, use_mmap=use_mmap, stats=stats)
+
+            self.assertEqual(set(sections), kosmograd.WANTED_SECTIONS)
+            self.assertEqual(sections["debug_info_sec"].size, len("info bytes"))
+            self.assertIsNone(sections["debug_line_sec"])
+            # Sections aren't read until they're used.
+            self.assertEqual(stats, {})
+
+            self.assertEqual(sections["debug_str_sec"].stream.read(), "str\0")
+            sections["debug_info_sec"].stream.seek(5)
+            self.assertEqual(sections["debug_info_sec"].stream.read(3), "byt")
+            self.assertEqual(stats, {"debug_str_sec": 4, "debug_info_sec": 3})
+
+    def test_missing_DWARF_segment(self):
+        path = self.write_file(build_macho([("__TEXT", [])]))
+        with self.assertRaisesRegexp(Exception, "Could not find DWARF segment"):
+            kosmograd.read_dwarf_sections(path)
+
+    def test_truncated_file(self):
+        data = build_macho(self.SEGMENTS)
+        for size in (16, 40, 120):
+            with self.open_file(data[:size]) as handle:
+                with self.assertRaisesRegexp(Exception, "Truncated Mach-O file"):
+                    list(kosmograd.iter_segments(handle))
+
+    def test_not_64_bit_Mach_O(self):
+        for magic in (0xfeedface, 0xcffaedfe, 0x464c457f):
+            with self.open_file(build_macho(self.SEGMENTS, magic=magic)) as handle:
+                with self.assertRaisesRegexp(Exception, "Not a little-endian 64-bit Mach-O file"):
+                    list(kosmograd.iter_segments(handle))
+
+class TestDIEReader(unittest.TestCase):
+    def test_reads_what_pyelftools_reads(self):
+        forms = set()
+        for filename in FIXTURES:
+            _, dwarf = kosmograd.open_dwarf(filename)
+            for cu in dwarf.iter_CUs():
+                reader = kosmograd.DIEReader(dwarf, cu)
+                # Every DIE in order, null DIEs included.
+                dies = list(cu.iter_DIEs())
+                self.assertEqual(dies[-1].offset + dies[-1].size, kosmograd.CU_end(cu))
+
+                for die in dies:
+                    entry = reader.read_DIE(die.offset)
+                    # pyelftools leaves a null DIE's has_children None.
+                    self.assertEqual((entry.abbrev_code, entry.tag, entry.size, entry.has_children),
+                                     (die.abbrev_code, die.tag, die.size, bool(die.has_children)))
+                    self.assertEqual(list(entry.attributes), list(die.attributes))
+                    for name, expected in die.attributes.iteritems():
+                        forms.add(expected.form)
+                        if expected.form == "DW_FORM_flag_present":
+                            expected = expected._replace(value=True, raw_value=True)
+                        self.assertEqual(entry.attributes[name], expected)
+
+                # skip_children lands just past each DIE's children, having
+                # counted those that aren't null.
+                ends = []
+                for i, die in enumerate(dies):
+                    if die.is_null():
+                        if ends:
+                            start, count = ends.pop()
+                            end = die.offset + die.size
+                            self.assertEqual(reader.skip_children(start), (end, count))
+                        continue
+                    for parent in ends:
+                        parent[1] += 1
+                    if die.has_children:
+                        ends.append([die.offset + die.size, 0])
+                self.assertEqual(ends, [])
+
+        self.assertTrue(set(["DW_FORM_strp", "DW_FORM_string", "DW_FORM_flag_present",
+                             "DW_FORM_exprloc", "DW_FORM_sec_offset", "DW_FORM_ref4",
+                             "DW_FORM_ref_addr", "DW_FORM_data1", "DW_FORM_addr"]) <= forms,
+                        forms)
+
+    def test_unsupported_forms_are_reported(self):
+        class Declaration(dict):
+            def has_children(self):
+                return False
+
+            def iter_attr_specs(self):
+                return [("DW_AT_name", "DW_FORM_GNU_str_index")]
+
+        _, dwarf = kosmograd.open_dwarf(HELLO)
+        reader = kosmograd.DIEReader(dwarf, next(dwarf.iter_CUs()))
+        with self.assertRaisesRegexp(Exception, "Unsupported attribute form DW_FORM_GNU_str_index"):
+            kosmograd.AbbrevLayout(Declaration(tag="DW_TAG_variable"), reader._sizes,
+                                   reader._decoders)
+
+def visit_all(filename):
+    _, dwarf = kosmograd.open_dwarf(filename)
+    dbg_info = kosmograd.DebugInfo(dwarf)
+    for cu in dwarf.iter_CUs():
+        dbg_info.visit(cu)
+    return dbg_info
+
+class TestScopes(unittest.TestCase):
+    def test_nested_shadowing_scopes(self):
+        # shadow() in hello.c declares `s` in itself and in two nested blocks.
+        dbg_info = visit_all(HELLO)
+        scopes = dbg_info.as_dict()["scopes"]
+        shadow = [i for i, scope in enumerate(scopes) if scope["name"] == "shadow"]
+        self.assertEqual(len(shadow), 1)
+
+        chain = shadow
+        while True:
+            children = [i for i, scope in enumerate(scopes)
+                        if scope.get("parent") == chain[-1] and i != 0]
+            if not children:
+                break
+            self.assertEqual(len(children), 1)
+            chain.extend(children)
+
+        self.assertEqual(len(chain), 3)
+        self.assertEqual(scopes[chain[0]]["parent"], 0)
+        for parent, child in zip(chain, chain[1:]):
+            self.assertEqual(scopes[child]["parent"], parent)
+            self.assertGreater(child, parent)
+
+        # Each `s` is its own variable, in its own stack slot.
+        locations = [scopes[i]["bindings"]["s"]["location"] for i in chain]
+        self.assertEqual(len(set(locations)), 3)
+
+        innermost = scopes[chain[-1]]
+        address = innermost["ranges"][0][0]
+        self.assertEqual(dbg_info.scopes_at(address), list(reversed(chain)) + [0])
+
+    def test_nesting_deeper_than_the_recursion_limit(self):
+        dbg_info = visit_all(NESTED)
+        scopes = dbg_info.as_dict()["scopes"]
+        depth = 0
+        scope = scopes[-1]
+        while scope.get("parent"):
+            depth += 1
+            scope = scopes[scope["parent"]]
+        self.assertGreater(depth, sys.getrecursionlimit())
+
+        address = scopes[-1]["ranges"][0][0]
+        self.assertEqual(len(dbg_info.scopes_at(address)), depth + 2)
+        json.loads(dump_json(dbg_info))
+
+def dump_json(dbg_info):
+    out = StringIO.StringIO()
+    dbg_info.write_json(out)
+    return out.getvalue()
+
+class TestWriteJSON(unittest.TestCase):
+    def test_matches_as_json(self):
+        for filename in FIXTURES + [NESTED]:
+            expected = visit_all(filename).as_json(indent=kosmograd.JSON_INDENT)
+
+            # Spill all but the last CU's scopes, so that both kinds are written.
+            _, dwarf = kosmograd.open_dwarf(filename)
+            dbg_info = kosmograd.DebugInfo(dwarf, spool=tempfile.TemporaryFile())
+            cus = list(dwarf.iter_CUs())
+            for cu in cus[:-1]:
+                dbg_info.visit(cu)
+                dbg_info.spill_scopes()
+            dbg_info.visit(cus[-1])
+            if len(cus) > 1:
+                self.assertGreater(dbg_info._spilled_scopes, 0)
+
+            self.assertEqual(dump_json(dbg_info), expected)
+
+class TestSkipping(unittest.TestCase):
+    def test_skipping_subtrees_changes_nothing(self):
+        may_contain = kosmograd.may_contain
+        for filename in FIXTURES:
+            kosmograd.may_contain = lambda tag, child_tags, interesting_tags: True
+            try:
+                unskipped = visit_all(filename)
+            finally:
+                kosmograd.may_contain = may_contain
+            skipped = visit_all(filename)
+
+            self.assertEqual(unskipped.skipped_subtrees, 0)
+            self.assertGreater(skipped.skipped_subtrees, 0)
+            self.assertEqual(dump_json(skipped), dump_json(unskipped))
+
+    def test_siblings_are_where_skip_children_lands(self):
+        siblings = 0
+        for filename in FIXTURES:
+            _, dwarf = kosmograd.open_dwarf(filename)
+            for cu in dwarf.iter_CUs():
+                reader = kosmograd.DIEReader(dwarf, cu)
+                for die in cu.iter_DIEs():
+                    if die.has_children and "DW_AT_sibling" in die.attributes:
+                        siblings += 1
+                        sibling = kosmograd.reference_offset(cu, die.attributes["DW_AT_sibling"])
+                        end, _ = reader.skip_children(die.offset + die.size)
+                        self.assertEqual(end, sibling)
+        self.assertGreater(siblings, 0)
+
+class TestMerge(unittest.TestCase):
+    def test_merged_output_matches_serial_output(self):
+        referenced_CUs = []
+        for filename in FIXTURES:
+            _, dwarf = kosmograd.open_dwarf(filename)
+            merged = kosmograd.DebugInfo(dwarf)
+            for cu in dwarf.iter_CUs():
+                result, inputs = kosmograd.visit_CU(dwarf, cu)
+                referenced_CUs.extend(inputs["referenced_CUs"])
+                # As results arrive from --jobs workers or the CU cache.
+                merged.merge(marshal.loads(marshal.dumps(result)))
+
+            self.assertEqual(dump_json(merged), dump_json(visit_all(filename)))
+
+        # The LTO build's types shared between CUs are merged only once.
+        self.assertTrue(referenced_CUs)
+
+    def test_bindings_keep_their_binding_order(self):
+        # A dict's iteration order depends on the order its keys went in when
+        # they collide, so merged bindings must go in in the original order.
+        names = ["v%d" % i for i in reversed(xrange(200))]
+        expected = {}
+        for name in names:
+            expected[name] = {"location": None, "type": 0}
+
+        _, dwarf = kosmograd.open_dwarf(HELLO)
+        merged = kosmograd.DebugInfo(dwarf)
+        merged.merge({
+            "types": [{"kind": "base_type"}],
+            "type_offsets": [0],
+            "scopes": [{"name": "Global", "bindings": [[name, expected[name]] for name in names]}],
+            "files": []
+        })
+        self.assertEqual(list(merged.scope(0)["bindings"]), list(expected))
+
+def find_CU(dwarf, filename):
+    """ The CU compiled from the source file `filename`. """
+    for cu in dwarf.iter_CUs():
+        if cu.get_top_DIE().attributes["DW_AT_name"].value.endswith(filename):
+            return cu
+
+def find_DIE(cu, tag, name):
+    """ The DIE in `cu` that defines, rather than declares, `name`. """
+    for die in cu.iter_DIEs():
+        attributes = die.attributes
+        if (die.tag == tag and "DW_AT_declaration" not in attributes and
+                "DW_AT_name" in attributes and attributes["DW_AT_name"].value == name):
+            return die
+
+def read_sections(filename):
+    """ The (sectname, data) of each of the DWARF sections of `filename`, as
+        for build_macho.
+    """
+    sections, _ = kosmograd.open_dwarf(filename)
+    contents = []
+    for name, section in sorted(sections.items()):
+        if section is not None:
+            section.stream.seek(0)
+            contents.append(("__" + name[:-len("_sec")], section.stream.read()))
+    return contents
+
+class TestLineTableIndex(TempDirTestCase):
+    def test_batch_matches_single_lookups(self):
+        _, dwarf = kosmograd.open_dwarf(HELLO)
+        rows = kosmograd.sample_line_addresses(dwarf, 1000)
+        # Every row, the addresses either side of each, and ones before and
+        # after all of them, shuffled.
+        addresses = sorted(set(a + d for a in rows for d in (-1, 0, 1)) | {0, 2 ** 63})
+        addresses = addresses[1::2] + addresses[::2]
+
+        line_table = kosmograd.LineTableIndex(dwarf)
+        expected = [line_table.location_for(address) for address in addresses]
+        self.assertIn(None, expected)
+        self.assertGreater(len(filter(None, expected)), len(rows))
+        self.assertEqual(line_table.locations_for(addresses), expected)
+
+    def test_CU_without_line_program(self):
+        # Append a CU whose only DIE is a compile_unit with just a name: no
+        # address ranges, so it's searched for every unowned address, and no
+        # DW_AT_stmt_list, so no line program.
+        sections = dict(read_sections(HELLO))
+        abbrev_offset = len(sections["__debug_abbrev"])
+        sections["__debug_abbrev"] += "\x01\x11\x00\x03\x08\x00\x00\x00"
+        die = "\x01nolines.c\x00"
+        sections["__debug_info"] += struct.pack("<IHIB", 7 + len(die), 4, abbrev_offset, 8) + die
+        path = self.write_file(build_macho([("__DWARF", sorted(sections.items()))]))
+
+        _, dwarf = kosmograd.open_dwarf(path)
+        self.assertEqual(len(list(dwarf.iter_CUs())), 3)
+        self.assertIsNone(kosmograd.line_program_for_CU(dwarf, list(dwarf.iter_CUs())[-1]))
+
+        _, hello = kosmograd.open_dwarf(HELLO)
+        addresses = kosmograd.sample_line_addresses(hello, 1000) + [0, 2 ** 63]
+        expected = [kosmograd.LineTableIndex(hello).location_for(a) for a in addresses]
+        line_table = kosmograd.LineTableIndex(dwarf)
+        self.assertEqual([line_table.location_for(a) for a in addresses], expected)
+        self.assertEqual(line_table.locations_for(addresses), expected)
+        self.assertEqual(dump_json(visit_all(path)), dump_json(visit_all(HELLO)))
+
+class TestCUCache(TempDirTestCase):
+    def merge(self, filename, cache):
+        args = argparse.Namespace(filename=filename, jobs=1, mmap=False)
+        _, dwarf = kosmograd.open_dwarf(filename)
+        dbg_info = kosmograd.DebugInfo(dwarf)
+        recomputed = kosmograd.merge_CU_results(args, dwarf, dbg_info, cache)
+        self.assertEqual(dump_json(dbg_info), dump_json(visit_all(filename)))
+        return recomputed
+
+    def write_modified(self, filename, section, offset, value):
+        """ Write a copy of `filename` with the byte at `offset` in `section`
+            set to `value`, and return its path.
+        """
+        sections, _ = kosmograd.open_dwarf(filename)
+        with open(filename, "rb") as f:
+            data = bytearray(f.read())
+        data[sections[section].global_offset + offset] = value
+        return self.write_file(str(data), name="modified")
+
+    def test_only_changed_CU_is_recomputed(self):
+        # Move the definition of goodbye() down a line in goodbye.c's CU.
+        _, dwarf = kosmograd.open_dwarf(HELLO)
+        hello_cu, goodbye_cu = find_CU(dwarf, "hello.c"), find_CU(dwarf, "goodbye.c")
+        decl_line = find_DIE(goodbye_cu, "DW_TAG_subprogram", "goodbye").attributes["DW_AT_decl_line"]
+        self.assertEqual(decl_line.form, "DW_FORM_data1")
+        modified = self.write_modified(HELLO, "debug_info_sec", decl_line.offset,
+                                       decl_line.value + 1)
+
+        cache = kosmograd.OutputCache(os.path.join(self.directory, "cache"), 1 << 30)
+        both = [hello_cu.cu_offset, goodbye_cu.cu_offset]
+        self.assertEqual(self.merge(HELLO, cache), both)
+        self.assertEqual(self.merge(HELLO, cache), [])
+        self.assertEqual(self.merge(modified, cache), [goodbye_cu.cu_offset])
+        self.assertEqual(self.merge(modified, cache), [])
+
+        _, dwarf = kosmograd.open_dwarf(modified)
+        goodbye = find_DIE(find_CU(dwarf, "goodbye.c"), "DW_TAG_subprogram", "goodbye")
+        self.assertEqual(goodbye.attributes["DW_AT_decl_line"].value, decl_line.value + 1)
+
+    def test_CUs_are_recomputed_when_their_lists_change(self):
+        # In hello-O2.macho, only hello.c's CU has location and range lists.
+        _, dwarf = kosmograd.open_dwarf(HELLO_O2)
+        cus = [find_CU(dwarf, "hello.c"), find_CU(dwarf, "goodbye.c")]
+        inputs = [kosmograd.visit_CU(dwarf, cu)[1] for cu in cus]
+        self.assertEqual([len(i["location_lists"]) for i in inputs], [1, 0])
+        self.assertEqual([len(i["range_lists"]) for i in inputs], [2, 0])
+
+        # A variable moving from one register to another in .debug_loc: the
+        # list's first entry's expression follows its start and end addresses
+        # and its length.
+        start, _ = inputs[0]["location_lists"][0]
+        expression = start + 2 * cus[0]["address_size"] + 2
+        opcode = ord(kosmograd.read_section_range(dwarf.debug_loc_sec, expression, 1))
+        self.assertEqual(kosmograd.DW_OP_opcode2name[opcode], "DW_OP_reg2")
+        moved = self.write_modified(HELLO_O2, "debug_loc_sec", expression, opcode - 1)
+
+        # A range ending a byte earlier in .debug_ranges.
+        start, _ = inputs[0]["range_lists"][0]
+        end = start + 2 * cus[0]["address_size"]
+        shortened = self.write_modified(
+            HELLO_O2, "debug_ranges_sec", end,
+            ord(kosmograd.read_section_range(dwarf.debug_ranges_sec, end, 1)) - 1)
+
+        both = [cu.cu_offset for cu in cus]
+        for modified in (moved, shortened):
+            cache = kosmograd.OutputCache(os.path.join(self.directory, "cache"), 1 << 30)
+            self.assertEqual(self.merge(HELLO_O2, cache), both)
+            self.assertEqual(self.merge(modified, cache), both[:1])
+            self.assertEqual(self.merge(modified, cache), [])
+            self.assertEqual(self.merge(HELLO_O2, cache), both[:1])
+            shutil.rmtree(cache.directory)
+
+    def test_evicted_entries_are_recomputed(self):
+        # Too small for both CUs' entries, so only goodbye.c's is left. It's
+        # valid, but storing hello.c's again evicts it before it's merged.
+        _, dwarf = kosmograd.open_dwarf(HELLO)
+        both = [cu.cu_offset for cu in dwarf.iter_CUs()]
+        cache = kosmograd.OutputCache(os.path.join(self.directory, "cache"), 1)
+        self.assertEqual(self.merge(HELLO, cache), both)
+        self.assertEqual(self.merge(HELLO, cache), both)
+
+        stats = cache.stats()
+        self.assertEqual(stats["entries"], 1)
+        cache.save_stats()
+        self.assertEqual(kosmograd.OutputCache(cache.directory, 1).stats(), stats)
+
+class TestSymbolicator(unittest.TestCase):
+    def test_scope_locations_name_their_source(self):
+        symbolicator = kosmograd.Symbolicator(HELLO)
+        # Shares the DebugInfo's line tables rather than building its own.
+        self.assertIs(symbolicator.debug_info._line_table, symbolicator._line_table)
+
+        dbg_info = visit_all(HELLO)
+        scopes = dbg_info.as_dict()["scopes"]
+        shadow = [scope for scope in scopes if scope["name"] == "shadow"][0]
+        address = shadow["ranges"][0][0]
+
+        found = symbolicator.scopes_at(address)
+        self.assertEqual([scope["name"] for scope in found], ["shadow", "Global"])
+        self.assertEqual(found[0]["start"], symbolicator.location_for(address))
+        self.assertEqual(found[0]["start"]["source"], dbg_info.file(shadow["start"]["file"]))
+        self.assertEqual(found[0]["end"]["source"], found[0]["start"]["source"])
+        self.assertEqual(found[0]["end"]["line"], shadow["end"]["line"])
+        self.assertEqual(json.loads(symbolicator.query("scopes %#x" % address)), found)
+
+        # The DebugInfo's own scopes are left as they were.
+        self.assertEqual(symbolicator.debug_info.scope(scopes.index(shadow)), shadow)
+
+class TestServeSocket(TempDirTestCase):
+    def test_does_not_replace_other_files(self):
+        path = self.write_file("precious", name="socket")
+        with self.assertRaisesRegexp(Exception, "not a socket"):
+            kosmograd.serve_socket(None, path)
+        with open(path) as f:
+            self.assertEqual(f.read(), "precious")
+
+def decode(*data):
+    return kosmograd.decode_location_expression("".join(map(chr, data)), 8, 4)
+
+class TestLocationExpressions(unittest.TestCase):
+    def test_decode_multi_byte_fbreg(self):
+        self.assertEqual(decode(0x91, 0x7c), [["fbreg", -4]])
+        self.assertEqual(decode(0x91, 0xb0, 0x7e), [["fbreg", -208]])
+        self.assertEqual(decode(0x91, 0xc8, 0x01), [["fbreg", 200]])
+        self.assertEqual(decode(0x91, 0x80, 0x80, 0x7f), [["fbreg", -(1 << 14)]])
+
+    def test_decode_operands(self):
+        self.assertEqual(decode(0x03, *range(1, 9)), [["addr", 0x0807060504030201]])
+        self.assertEqual(decode(0x75, 0x10, 0x06, 0x94, 0x04),
+                         [["breg5", 16], ["deref"], ["deref_size", 4]])
+        self.assertEqual(decode(0x92, 0x21, 0x7f, 0x9f), [["bregx", 33, -1], ["stack_value"]])
+        self.assertEqual(decode(0x9e, 0x02, 0x34, 0x12), [["implicit_value", 0x1234]])
+
+    def test_decode_counts_branches_in_operations(self):
+        # lit0, bra to the lit3, lit2, skip past the lit3, lit3, stack_value
+        data = (0x30, 0x28, 0x04, 0x00, 0x32, 0x2f, 0x01, 0x00, 0x33, 0x9f)
+        self.assertEqual(decode(*data), [["lit0"], ["bra", 2], ["lit2"], ["skip", 1],
+                                         ["lit3"], ["stack_value"]])
+        # Backwards, to the first operation.
+        self.assertEqual(decode(0x96, 0x2f, 0xfc, 0xff), [["nop"], ["skip", -2]])
+
+    def test_decode_rejects_what_it_cannot_decode(self):
+        for data in [(0x01,),                       # reserved opcode
+                     (0x2f, 0x01, 0x00, 0x31, 0x00),  # skip into an operation
+                     (0x2f, 0x10, 0x00),            # skip out of the expression
+                     (0x91, 0x80),                  # truncated SLEB128
+                     (0x03, 0x01, 0x02, 0x03, 0x04),  # truncated address
+                     (0x0a, 0x01),                  # truncated const2u
+                     (0x9e, 0x05, 0x01)]:           # truncated block
+            self.assertIsNone(decode(*data), data)
+
+    def evaluate(self, data, **kwargs):
+        return kosmograd.evaluate_location(decode(*data), **kwargs)
+
+    def test_evaluate_branches(self):
+        data = [0x30, 0x28, 0x04, 0x00, 0x32, 0x2f, 0x01, 0x00, 0x33, 0x9f]
+        self.assertEqual(self.evaluate(data), ("value", 2))
+        data[0] = 0x31  # lit1, so the branch is taken
+        self.assertEqual(self.evaluate(data), ("value", 3))
+
+    def test_evaluate_stack_operations(self):
+        # lit1 lit2 lit3 rot: 3 1 2, then minus: 3 -1, then mul: -3
+        self.assertEqual(self.evaluate([0x31, 0x32, 0x33, 0x17, 0x1c, 0x1e, 0x9f]),
+                         ("value", -3))
+        # lit1 lit2 swap minus: 1
+        self.assertEqual(self.evaluate([0x31, 0x32, 0x16, 0x1c, 0x9f]), ("value", 1))
+        # lit5 lit3 over: 5 3 5, pick 1: 5 3 5 3, minus: 5 3 2, drop: 5 3,
+        # dup: 5 3 3, plus: 5 6, minus: -1
+        self.assertEqual(self.evaluate([0x35, 0x33, 0x14, 0x15, 0x01, 0x1c, 0x13, 0x12,
+                                        0x22, 0x1c, 0x9f]), ("value", -1))
+
+    def test_evaluate_division_truncates_toward_zero(self):
+        for a, b, quotient in [(7, 2, 3), (-7, 2, -3), (7, -2, -3), (-7, -2, 3)]:
+            data = [0x11, a & 0x7f, 0x11, b & 0x7f, 0x1b, 0x9f]
+            self.assertEqual(self.evaluate(data), ("value", quotient))
+        # shr is a logical shift of a 64-bit value, shra an arithmetic one.
+        self.assertEqual(self.evaluate([0x11, 0x78, 0x31, 0x25, 0x9f]),
+                         ("value", (1 << 63) - 4))
+        self.assertEqual(self.evaluate([0x11, 0x78, 0x31, 0x26, 0x9f]), ("value", -4))
+
+    def test_evaluate_locations(self):
+        registers = {5: 0x1000, 33: 0x2000}
+        memory = {0x1010: 0x3000}
+        kwargs = {"frame_base": 0x7000, "read_register": registers.get,
+                  "read_memory": lambda address, size: memory[address]}
+        self.assertEqual(self.evaluate([0x55], **kwargs), ("register", 5))
+        self.assertEqual(self.evaluate([0x90, 0x21], **kwargs), ("register", 33))
+        self.assertEqual(self.evaluate([0x91, 0x70], **kwargs), ("memory", 0x7000 - 16))
+        self.assertEqual(self.evaluate([0x75, 0x10, 0x06], **kwargs), ("memory", 0x3000))
+        self.assertEqual(self.evaluate([0x92, 0x21, 0x08, 0x23, 0x04], **kwargs),
+                         ("memory", 0x200c))
+        self.assertEqual(self.evaluate([0x9e, 0x02, 0x34, 0x12]), ("value", 0x1234))
+        # A frame offset, as LocationDecoder stores fbreg-only expressions.
+        self.assertEqual(kosmograd.evaluate_location(16, frame_base=0x7000),
+                         ("memory", 0x7000 - 16))
+
+    def test_evaluate_errors(self):
+        with self.assertRaisesRegexp(Exception, "No location"):
+            kosmograd.evaluate_location(None)
+        with self.assertRaisesRegexp(Exception, "needs the frame base"):
+            self.evaluate([0x91, 0x70])
+        with self.assertRaisesRegexp(Exception, "must end"):
+            self.evaluate([0x55, 0x9f])
+        with self.assertRaisesRegexp(Exception, "empty stack"):
+            self.evaluate([0x96])
+        with self.assertRaisesRegexp(Exception, "Can't evaluate DW_OP_piece"):
+            self.evaluate([0x30, 0x93, 0x08])
+
+class TestBinaryDump(unittest.TestCase):
+    def round_trip(self, data):
+        out = StringIO.StringIO()
+        kosmograd.write_binary_dump(data, out)
+        return kosmograd.read_binary_dump(StringIO.StringIO(out.getvalue()))
+
+    def test_round_trip(self):
+        data = visit_all(HELLO).as_dict()
+        self.assertEqual(self.round_trip(data), data)
+
+    def test_round_trip_of_every_location_kind(self):
+        location = {"file": 0, "line": 12, "column": 3}
+        data = {
+            "types": [{"kind": "base_type"}, {"kind": "pointer_type", "parent": 0}],
+            "scopes": [
+                {"name": "Global", "bindings": {
+                    "g": {"location": [["addr", 0x100001000]], "type": 0}
+                }},
+                {"start": location, "end": None, "ranges": [[0x1000, 0x1040], [0x2000, 0x2001]],
+                 "bindings": {
+                     "unknown": {"location": None, "type": 1},
+                     "below": {"location": 20, "type": 0},
+                     "above": {"location": -16, "type": 0},
+                     "computed": {"location": [["breg7", -8], ["deref"], ["plus_uconst", 4],
+                                               ["stack_value"]], "type": 0},
+                     "list": {"location": {"list": [
+                         {"start": 0x1000, "end": 0x1010, "location": [["reg5"]]},
+                         {"start": 0x1010, "end": 0x1040, "location": -24},
+                         {"start": 0x1040, "end": 0x1040, "location": None}
+                     ]}, "type": 1}
+                 },
+                 "name": "f", "parent": 0},
+                {"start": None, "end": None, "ranges": [], "bindings": {}, "name": None,
+                 "parent": 1}
+            ],
+            "files": ["hello.c"]
+        }
+        self.assertEqual(self.round_trip(data), data)
+
+if __name__ == "__main__":
+    unittest.main()